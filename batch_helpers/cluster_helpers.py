@@ -0,0 +1,436 @@
+#!/usr/bin/python
+"""Functions that help with clustering sequences within a memory budget."""
+
+import os
+import re
+import time
+import shutil
+import logging
+import resource
+import subprocess
+import multiprocessing
+from collections import OrderedDict
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+from exec_helpers import reservoir_sample
+
+# Taxonomic levels used to split the sequences (as in cluster.split), and
+# distance cutoffs, tried in order until the largest group fits in memory
+TAXLEVELS = [4, 5, 6]
+CUTOFFS = [0.15, 0.1, 0.05, 0.03]
+
+# Approximate memory used by mothur for each distance below the cutoff,
+# plus a fixed amount for each mothur process
+BYTES_PER_DISTANCE = 64
+BYTES_PER_PROCESS = 256 * 1024 * 1024
+
+# Number of sequences used to estimate the fraction of distances below the cutoff
+N_SAMPLE_SEQS = 100
+
+GAP_CHARS = set("-.")
+
+# Number of group files kept open at once while splitting the sequences
+MAX_OPEN_FILES = 256
+
+
+def read_taxonomy_groups(taxonomy_fp, taxlevel):
+    """Group sequences by their classification at `taxlevel`, return a dict."""
+    groups = {}
+    with open(taxonomy_fp, "rt") as f:
+        for line in f:
+            name, lineage = line.rstrip("\n").split("\t")
+            # Remove the confidence scores, e.g. "Bacteria(100);"
+            lineage = [
+                re.sub(r"\(\d+\)$", "", taxon)
+                for taxon in lineage.rstrip(";").split(";")
+            ]
+            group = ";".join(lineage[:taxlevel])
+            groups.setdefault(group, []).append(name)
+    return groups
+
+
+def aligned_distance(seq1, seq2):
+    """Fraction of mismatches between two aligned sequences."""
+    n_cols, n_mismatches = 0, 0
+    for a, b in zip(seq1, seq2):
+        if a in GAP_CHARS and b in GAP_CHARS:
+            continue
+        n_cols += 1
+        if a != b:
+            n_mismatches += 1
+    if n_cols == 0:
+        return 1.
+    return n_mismatches / float(n_cols)
+
+
+def estimate_fraction_within_cutoffs(fasta_fp, names, cutoffs, seed=0):
+    """Estimate the fraction of pairwise distances below each cutoff.
+
+    The estimate is made from a random sample of the sequences in `names`.
+    """
+    names = set(names)
+    with open(fasta_fp, "rt") as f:
+        seqs, n_seqs = reservoir_sample(
+            (seq for header, seq in SimpleFastaParser(f)
+             if header.split()[0] in names),
+            N_SAMPLE_SEQS,
+            seed=seed
+        )
+    if len(seqs) < 2:
+        return dict([(cutoff, 1.) for cutoff in cutoffs])
+
+    # Skip the columns which are gaps in every sequence
+    keep = [
+        ix for ix in range(len(seqs[0]))
+        if any([seq[ix] not in GAP_CHARS for seq in seqs])
+    ]
+    seqs = ["".join([seq[ix] for ix in keep]) for seq in seqs]
+
+    dists = []
+    for ix, seq1 in enumerate(seqs):
+        for seq2 in seqs[ix + 1:]:
+            dists.append(aligned_distance(seq1, seq2))
+
+    return dict([
+        (cutoff, len([d for d in dists if d <= cutoff]) / float(len(dists)))
+        for cutoff in cutoffs
+    ])
+
+
+def estimate_cluster_memory(n_seqs, fraction_within_cutoff):
+    """Estimate the memory (bytes) needed to cluster a group of sequences."""
+    n_dists = n_seqs * (n_seqs - 1) / 2. * fraction_within_cutoff
+    return int(BYTES_PER_PROCESS + n_dists * BYTES_PER_DISTANCE)
+
+
+def choose_cluster_params(fasta_fp, taxonomy_fp, memory_budget, seed=0):
+    """Pick the split level and cutoff so that the largest group fits in memory.
+
+    Returns (taxlevel, cutoff, groups, estimated memory for the largest group).
+    """
+    for taxlevel in TAXLEVELS:
+        groups = read_taxonomy_groups(taxonomy_fp, taxlevel)
+        largest = max(groups.values(), key=len)
+        fractions = estimate_fraction_within_cutoffs(
+            fasta_fp, largest, CUTOFFS, seed=seed
+        )
+        for cutoff in CUTOFFS:
+            estimate = estimate_cluster_memory(len(largest), fractions[cutoff])
+            logging.info(
+                "taxlevel={}, cutoff={}: {:,} groups, largest has {:,} sequences ({:,} MB)".format(
+                    taxlevel, cutoff, len(groups), len(largest), estimate // 1024 ** 2
+                )
+            )
+            if estimate <= memory_budget:
+                return taxlevel, cutoff, groups, estimate
+
+    logging.info("No parameters fit within {:,} MB, using taxlevel={}, cutoff={}".format(
+        memory_budget // 1024 ** 2, taxlevel, cutoff
+    ))
+    return taxlevel, cutoff, groups, estimate
+
+
+class GroupFileWriter(object):
+    """Append lines to a set of files, keeping at most `max_open` of them open.
+
+    Files are reopened (in append mode) as needed, closing the one which
+    was used least recently, so that the number of groups is not limited
+    by the number of files a process can have open.
+    """
+
+    def __init__(self, fps, max_open=MAX_OPEN_FILES):
+        self.fps = fps
+        self.max_open = max_open
+        self.handles = OrderedDict()
+        # Start each file empty
+        for fp in fps:
+            open(fp, "wt").close()
+
+    def write(self, ix, text):
+        handle = self.handles.pop(ix, None)
+        if handle is None:
+            if len(self.handles) >= self.max_open:
+                _, oldest = self.handles.popitem(last=False)
+                oldest.close()
+            handle = open(self.fps[ix], "at")
+        self.handles[ix] = handle
+        handle.write(text)
+
+    def close(self):
+        for handle in self.handles.values():
+            handle.close()
+        self.handles = OrderedDict()
+
+
+def write_group_inputs(fasta_fp, count_fp, groups, cluster_folder):
+    """Write out the FASTA and count table for each group, return the folders."""
+    group_folders = []
+    group_ix = {}
+    for ix, group in enumerate(sorted(groups)):
+        group_folder = os.path.join(cluster_folder, "group_{}".format(ix))
+        os.mkdir(group_folder)
+        group_folders.append(group_folder)
+        for name in groups[group]:
+            group_ix[name] = ix
+
+    writer = GroupFileWriter([
+        os.path.join(folder, "group.fasta") for folder in group_folders
+    ])
+    with open(fasta_fp, "rt") as f:
+        for header, seq in SimpleFastaParser(f):
+            name = header.split()[0]
+            writer.write(group_ix[name], ">{}\n{}\n".format(name, seq))
+    writer.close()
+
+    writer = GroupFileWriter([
+        os.path.join(folder, "group.count_table") for folder in group_folders
+    ])
+    with open(count_fp, "rt") as f:
+        header = f.readline()
+        for ix in range(len(group_folders)):
+            writer.write(ix, header)
+        for line in f:
+            writer.write(group_ix[line.split("\t", 1)[0]], line)
+    writer.close()
+
+    return group_folders
+
+
+def run_bounded_mothur_command(command_string, folder, max_memory):
+    """Run a mothur batch within `folder`, limited to `max_memory` bytes.
+
+    Returns the exit status (negative if killed by a signal) and the peak
+    memory (bytes) used by the mothur process.
+    """
+    batch_fp = os.path.join(folder, "mothur.batch")
+    with open(batch_fp, "wt") as fo:
+        fo.write(command_string + "\n")
+
+    def limit_memory():
+        resource.setrlimit(resource.RLIMIT_AS, (max_memory, max_memory))
+
+    # Write the output to a file, so that the resource usage of this
+    # process can be read when it exits
+    with open(os.path.join(folder, "mothur.stdout"), "wt") as fo:
+        p = subprocess.Popen(["mothur", batch_fp],
+                             stdout=fo,
+                             stderr=subprocess.STDOUT,
+                             cwd=folder,
+                             preexec_fn=limit_memory)
+        _, status, rusage = os.wait4(p.pid, 0)
+    if os.WIFSIGNALED(status):
+        status = -os.WTERMSIG(status)
+    else:
+        status = os.WEXITSTATUS(status)
+    if status != 0:
+        logging.info("Exit status was {} for {}".format(status, batch_fp))
+
+    # ru_maxrss is reported in kilobytes
+    return status, rusage.ru_maxrss * 1024
+
+
+def write_singleton_list(fasta_fp, list_fp):
+    """Write a mothur list file in which each sequence is its own OTU."""
+    with open(fasta_fp, "rt") as f:
+        names = [header.split()[0] for header, seq in SimpleFastaParser(f)]
+    with open(list_fp, "wt") as fo:
+        fo.write("unique\t{}\t{}\n".format(len(names), "\t".join(names)))
+
+
+def cluster_group(group_folder, cutoff, max_memory):
+    """Cluster the sequences in a single group, return (list_fp, dist_fp, stats).
+
+    If mothur fails (e.g. by running out of memory), the group is tried
+    again with each smaller cutoff in turn. If every cutoff fails,
+    list_fp is None, and the failures are listed in the stats.
+    """
+    fasta_fp = os.path.join(group_folder, "group.fasta")
+    count_fp = os.path.join(group_folder, "group.count_table")
+    dist_fp = os.path.join(group_folder, "group.dist")
+    singleton_list_fp = os.path.join(group_folder, "group.unique.list")
+
+    with open(count_fp, "rt") as f:
+        n_seqs = len(f.readlines()) - 1
+
+    start_time = time.time()
+    peak_memory = 0
+    list_fp = None
+    failures = []
+    cutoffs = [cutoff] + [c for c in CUTOFFS if c < cutoff]
+    if n_seqs <= 1:
+        write_singleton_list(fasta_fp, singleton_list_fp)
+        list_fp = singleton_list_fp
+        cutoffs = []
+
+    for group_cutoff in cutoffs:
+        status, memory = run_bounded_mothur_command(
+            """dist.seqs(fasta={fasta}, cutoff={cutoff}, processors=1)
+cluster(column={dist}, count={count}, cutoff={cutoff})""".format(
+                fasta=fasta_fp,
+                dist=dist_fp,
+                count=count_fp,
+                cutoff=group_cutoff
+            ),
+            group_folder,
+            max_memory
+        )
+        peak_memory = max(peak_memory, memory)
+
+        list_fps = [f for f in os.listdir(group_folder) if f.endswith(".list")]
+        if status == 0 and len(list_fps) == 1:
+            list_fp = os.path.join(group_folder, list_fps[0])
+            cutoff = group_cutoff
+            break
+        elif status == 0 and os.path.exists(dist_fp) and os.stat(dist_fp).st_size == 0:
+            # No distances below the cutoff, so each sequence is its own OTU
+            write_singleton_list(fasta_fp, singleton_list_fp)
+            list_fp = singleton_list_fp
+            cutoff = group_cutoff
+            break
+        else:
+            logging.info("Clustering failed for {} with cutoff={} (exit status {})".format(
+                group_folder, group_cutoff, status
+            ))
+            failures.append("{}:{}".format(group_cutoff, status))
+            # Remove the partial outputs before trying again
+            for f in os.listdir(group_folder):
+                if f not in ["group.fasta", "group.count_table"]:
+                    os.remove(os.path.join(group_folder, f))
+
+    stats = {
+        "n_seqs": n_seqs,
+        "cutoff": cutoff,
+        "peak_memory": peak_memory,
+        "elapsed": time.time() - start_time,
+        "failures": failures
+    }
+    if list_fp is not None:
+        logging.info("Clustered {:,} sequences in {} ({:,} MB peak)".format(
+            n_seqs, group_folder, peak_memory // 1024 ** 2
+        ))
+    return list_fp, dist_fp, stats
+
+
+def _cluster_group_star(args):
+    """Unpack the arguments for cluster_group (used by multiprocessing)."""
+    return cluster_group(*args)
+
+
+def label_value(label):
+    """Sort order for the labels of a mothur list file."""
+    if label == "unique":
+        return 0.
+    return float(label)
+
+
+def read_list_file(list_fp):
+    """Read a mothur list file, return a dict of label -> list of OTUs."""
+    otus = {}
+    with open(list_fp, "rt") as f:
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            if fields[0] == "label":
+                continue
+            otus[fields[0]] = fields[2:]
+    return otus
+
+
+def merge_list_files(list_fps, merged_fp):
+    """Combine the OTUs from each group into a single mothur list file.
+
+    For each label, groups without that label contribute the OTUs from
+    their closest smaller label, or one OTU per sequence below their
+    smallest label.
+    """
+    group_otus = [read_list_file(fp) for fp in list_fps]
+    labels = set()
+    for otus in group_otus:
+        labels.update(otus.keys())
+    labels = sorted(labels, key=label_value)
+
+    merged = []
+    for label in labels:
+        otus = []
+        for group in group_otus:
+            group_labels = sorted(group.keys(), key=label_value)
+            below = [l for l in group_labels if label_value(l) <= label_value(label)]
+            if len(below) > 0:
+                otus.extend(group[below[-1]])
+            else:
+                otus.extend([
+                    name for otu in group[group_labels[0]] for name in otu.split(",")
+                ])
+        merged.append((label, otus))
+
+    n_max = max([len(otus) for label, otus in merged])
+    otu_names = ["Otu{}".format(str(ix + 1).zfill(len(str(n_max)))) for ix in range(n_max)]
+    with open(merged_fp, "wt") as fo:
+        fo.write("\t".join(["label", "numOtus"] + otu_names) + "\n")
+        for label, otus in merged:
+            fo.write("\t".join([label, str(len(otus))] + otus) + "\n")
+
+
+def run_cluster_stage(fasta_fp, count_fp, taxonomy_fp, temp_folder,
+                      memory_budget, threads=16, seed=0):
+    """Cluster sequences split by taxonomy, keeping within a memory budget.
+
+    This stands in for cluster.split(splitmethod=classify), choosing the
+    split level and cutoff from the number of unique sequences. Returns
+    (list_fp, dist_fp, stats), where stats has a line per group, or
+    (None, None, stats) if any group could not be clustered.
+    """
+    taxlevel, cutoff, groups, estimate = choose_cluster_params(
+        fasta_fp, taxonomy_fp, memory_budget, seed=seed
+    )
+
+    # Run as many groups in parallel as will fit in the memory budget
+    workers = max(1, min(threads, memory_budget // estimate))
+    max_memory = max(estimate, memory_budget // workers)
+    logging.info("Clustering {:,} groups with taxlevel={}, cutoff={}, {:,} workers".format(
+        len(groups), taxlevel, cutoff, workers
+    ))
+
+    # mothur is run from within each group folder, so use absolute paths
+    cluster_folder = os.path.abspath(os.path.join(temp_folder, "cluster"))
+    os.mkdir(cluster_folder)
+    group_folders = write_group_inputs(fasta_fp, count_fp, groups, cluster_folder)
+
+    # Start the largest groups first
+    tasks = sorted(
+        [(folder, cutoff, max_memory) for folder in group_folders],
+        key=lambda task: -os.stat(os.path.join(task[0], "group.fasta")).st_size
+    )
+    pool = multiprocessing.Pool(workers)
+    try:
+        outputs = pool.map(_cluster_group_star, tasks)
+    finally:
+        pool.close()
+        pool.join()
+
+    group_names = dict([(folder, g) for folder, g in zip(group_folders, sorted(groups))])
+    stats = []
+    for (folder, _, _), (_, _, group_stats) in zip(tasks, outputs):
+        group_stats["group"] = group_names[folder]
+        group_stats["taxlevel"] = taxlevel
+        stats.append(group_stats)
+
+    failed = [
+        group_stats["group"]
+        for (group_list_fp, _, _), group_stats in zip(outputs, stats)
+        if group_list_fp is None
+    ]
+    if len(failed) > 0:
+        logging.info("Clustering failed at every cutoff for: " + ", ".join(failed))
+        return None, None, stats
+
+    # Name the outputs after the input FASTA, as cluster.split does
+    root = fasta_fp.rsplit(".", 1)[0]
+    list_fp = root + ".opti_mcc.list"
+    merge_list_files([group_list_fp for group_list_fp, _, _ in outputs], list_fp)
+    dist_fp = root + ".dist"
+    with open(dist_fp, "wt") as fo:
+        for _, group_dist_fp, _ in outputs:
+            if os.path.exists(group_dist_fp):
+                with open(group_dist_fp, "rt") as f:
+                    shutil.copyfileobj(f, fo)
+
+    return list_fp, dist_fp, stats
@@ -3,18 +3,21 @@
 
 import os
 import json
+import random
 import logging
 import subprocess
+from Bio.SeqIO.FastaIO import SimpleFastaParser
 from Bio.SeqIO.QualityIO import FastqGeneralIterator
 
 
-def run_cmds(commands, retry=0, catchExcept=False):
+def run_cmds(commands, retry=0, catchExcept=False, cwd=None):
     """Run commands and write out the log, combining STDOUT & STDERR."""
     logging.info("Commands:")
     logging.info(' '.join(commands))
     p = subprocess.Popen(commands,
                          stdout=subprocess.PIPE,
-                         stderr=subprocess.STDOUT)
+                         stderr=subprocess.STDOUT,
+                         cwd=cwd)
     stdout, stderr = p.communicate()
     exitcode = p.wait()
     if stdout:
@@ -30,7 +33,7 @@ def run_cmds(commands, retry=0, catchExcept=False):
     if exitcode != 0 and retry > 0:
         msg = "Exit code {}, retrying {} more times".format(exitcode, retry)
         logging.info(msg)
-        run_cmds(commands, retry=retry - 1)
+        run_cmds(commands, retry=retry - 1, cwd=cwd)
     elif exitcode != 0 and catchExcept:
         msg = "Exit code was {}, but we will continue anyway"
         logging.info(msg.format(exitcode))
@@ -59,14 +62,62 @@ def return_results(out, read_prefix, output_folder, temp_folder):
         run_cmds(['mv', temp_fp, output_folder])
 
 
-def fastq_to_fasta(fastq_in, fasta_out):
-    """Convert FASTQ to FASTA."""
-    n_seqs = 0
+def reservoir_sample(records, k, seed=0):
+    """Sample up to k records in a single pass, return (sample, n_records).
+
+    Only k records are held in memory at a time, and the sample is
+    returned in the same order as the records were read.
+    """
+    assert k > 0, "Sample size must be greater than zero"
+    rng = random.Random(seed)
+    reservoir = []
+    n_records = 0
+    for record in records:
+        if len(reservoir) < k:
+            reservoir.append((n_records, record))
+        else:
+            j = rng.randint(0, n_records)
+            if j < k:
+                reservoir[j] = (n_records, record)
+        n_records += 1
+
+    reservoir.sort(key=lambda x: x[0])
+    return [record for ix, record in reservoir], n_records
+
+
+def fastq_to_fasta(fastq_in, fasta_out, max_reads=None, seed=0):
+    """Convert FASTQ to FASTA, return (n_input, n_output).
+
+    If max_reads is set, a random subset of at most that many reads is kept.
+    """
     with open(fastq_in, "rt") as fi:
+        records = FastqGeneralIterator(fi)
+        if max_reads is not None:
+            records, n_input = reservoir_sample(records, max_reads, seed=seed)
+        n_seqs = 0
         with open(fasta_out, "wt") as fo:
-            for header, sequence, quality in FastqGeneralIterator(fi):
+            for header, sequence, quality in records:
                 # Write out the record
                 fo.write(">{}\n{}\n".format(header, sequence))
                 n_seqs += 1
+    if max_reads is None:
+        n_input = n_seqs
 
     logging.info("Converted {} records to FASTA".format(n_seqs))
+    if max_reads is not None:
+        logging.info("Subsampled {:,} of {:,} reads".format(n_seqs, n_input))
+    return n_input, n_seqs
+
+
+def subsample_fasta(fasta_in, fasta_out, max_reads, seed=0):
+    """Keep a random subset of at most max_reads, return (n_input, n_output)."""
+    with open(fasta_in, "rt") as fi:
+        records, n_input = reservoir_sample(
+            SimpleFastaParser(fi), max_reads, seed=seed
+        )
+    with open(fasta_out, "wt") as fo:
+        for header, sequence in records:
+            fo.write(">{}\n{}\n".format(header, sequence))
+
+    logging.info("Subsampled {:,} of {:,} reads".format(len(records), n_input))
+    return n_input, len(records)
@@ -0,0 +1,305 @@
+#!/usr/bin/python
+"""Functions that help with trimming the reference database to the amplicon."""
+
+import os
+import gzip
+import uuid
+import shutil
+import hashlib
+import logging
+from itertools import islice
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+from Bio.SeqIO.QualityIO import FastqGeneralIterator
+from exec_helpers import run_cmds
+from s3_helpers import s3_path_exists
+
+# Number of reads aligned to the reference to find the amplicon region
+REGION_SAMPLE_READS = 2000
+
+# Fraction of reads allowed to start before (or end after) the region
+REGION_QUANTILE = 0.025
+
+# Region coordinates are rounded outwards to a multiple of this number of
+# alignment columns, so that similar samples share the same cached reference
+REGION_GRID = 100
+
+# Object written to an entry in the S3 cache once it is complete
+CACHE_MARKER = ".complete"
+
+
+def parse_region(region_str):
+    """Parse a region formatted as START:END, return a tuple of ints."""
+    start, end = region_str.split(":")
+    start, end = int(start), int(end)
+    assert 0 < start < end, "Region must be formatted as START:END"
+    return start, end
+
+
+# Checksums of the files seen by this process, keyed by (path, size, mtime)
+_checksums = {}
+
+
+def file_checksum(fp):
+    """Calculate the MD5 checksum of a file (only once for each process)."""
+    stat = os.stat(fp)
+    key = (os.path.abspath(fp), stat.st_size, stat.st_mtime)
+    if key not in _checksums:
+        md5 = hashlib.md5()
+        with open(fp, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                md5.update(block)
+        _checksums[key] = md5.hexdigest()
+    return _checksums[key]
+
+
+def is_aligned_fasta(fasta_fp):
+    """Check whether the first sequence in a FASTA contains alignment gaps."""
+    with open(fasta_fp, "rt") as f:
+        for header, seq in SimpleFastaParser(f):
+            return "-" in seq or "." in seq
+    return False
+
+
+def sample_reads(read_fps, sample_fp, n_reads=REGION_SAMPLE_READS):
+    """Write the first reads from a set of FASTA/FASTQ files to a FASTA.
+
+    Reads are taken evenly from each file. The position of a read within
+    a file does not affect which part of the amplicon it covers.
+    """
+    n_per_file = n_reads // len(read_fps) + 1
+    n_written = 0
+    with open(sample_fp, "wt") as fo:
+        for fp in read_fps:
+            if fp.endswith(".gz"):
+                f = gzip.open(fp, "rt")
+            else:
+                f = open(fp, "rt")
+            if f.read(1) == "@":
+                f.seek(0)
+                records = (
+                    (header, seq) for header, seq, qual in FastqGeneralIterator(f)
+                )
+            else:
+                f.seek(0)
+                records = SimpleFastaParser(f)
+            for header, seq in islice(records, n_per_file):
+                fo.write(">{}\n{}\n".format(header.split()[0], seq))
+                n_written += 1
+            f.close()
+    logging.info("Sampled {:,} reads from {:,} files".format(n_written, len(read_fps)))
+
+
+def run_mothur_in_folder(command_string, folder):
+    """Run a mothur batch from within `folder`."""
+    batch_fp = os.path.join(folder, "mothur.batch")
+    with open(batch_fp, "wt") as fo:
+        fo.write(command_string + "\n")
+    run_cmds(["mothur", batch_fp], cwd=folder)
+
+
+def detect_region(read_fps, ref_fasta_fp, temp_folder, threads=16):
+    """Find the alignment columns covered by a sample of reads, return (start, end)."""
+    region_folder = os.path.abspath(
+        os.path.join(temp_folder, "region_" + str(uuid.uuid4())[:8])
+    )
+    os.mkdir(region_folder)
+    sample_fp = os.path.join(region_folder, "region_sample.fasta")
+    sample_reads(read_fps, sample_fp)
+
+    run_mothur_in_folder(
+        """align.seqs(fasta={}, reference={}, flip=t, processors={})
+summary.seqs(fasta=current, processors={})""".format(
+            sample_fp, os.path.abspath(ref_fasta_fp), threads, threads
+        ),
+        region_folder
+    )
+
+    summary_fp = os.path.join(region_folder, "region_sample.summary")
+    assert os.path.exists(summary_fp), "No output from summary.seqs"
+    starts, ends = [], []
+    with open(summary_fp, "rt") as f:
+        header = f.readline().rstrip("\n").split("\t")
+        for line in f:
+            fields = dict(zip(header, line.rstrip("\n").split("\t")))
+            starts.append(int(fields["start"]))
+            ends.append(int(fields["end"]))
+    assert len(starts) > 0, "No reads could be aligned to the reference"
+    shutil.rmtree(region_folder)
+
+    starts.sort()
+    ends.sort()
+    start = starts[int(REGION_QUANTILE * len(starts))]
+    end = ends[int((1 - REGION_QUANTILE) * (len(ends) - 1))]
+
+    # Round outwards to the grid
+    start = max(1, (start // REGION_GRID) * REGION_GRID)
+    end = -(-end // REGION_GRID) * REGION_GRID
+    logging.info("Reads cover alignment columns {:,} to {:,}".format(start, end))
+    return start, end
+
+
+def build_training_files(ref_fasta_fp, ref_taxonomy_fp, folder, threads=16):
+    """Write the files mothur builds from a reference on first use.
+
+    align.seqs and classify.seqs write their k-mer and training files next
+    to the reference, so they are run once on a single read while the
+    reference is being built, and never by the jobs which share it. The
+    outputs for the read itself are written next to it, and deleted.
+    """
+    training_folder = os.path.join(folder, "training")
+    os.mkdir(training_folder)
+    query_fp = os.path.join(training_folder, "query.fasta")
+    with open(ref_fasta_fp, "rt") as f, open(query_fp, "wt") as fo:
+        for header, seq in SimpleFastaParser(f):
+            fo.write(">{}\n{}\n".format(
+                header.split()[0], seq.replace("-", "").replace(".", "")
+            ))
+            break
+
+    run_mothur_in_folder(
+        """align.seqs(fasta={query}, reference={fasta}, processors={threads})
+classify.seqs(fasta={query}, template={fasta}, taxonomy={taxonomy}, method=wang, processors={threads})""".format(
+            query=query_fp,
+            fasta=ref_fasta_fp,
+            taxonomy=ref_taxonomy_fp,
+            threads=threads
+        ),
+        training_folder
+    )
+    shutil.rmtree(training_folder)
+
+
+def build_region_reference(ref_fasta_fp, ref_taxonomy_fp, region, output_folder, threads=16):
+    """Trim the reference to a region of the alignment with pcr.seqs.
+
+    The trimmed files keep the same names as the inputs, so that the
+    outputs of classify.seqs are named the same way. The files used by
+    align.seqs and classify.seqs are built in the same folder.
+    """
+    start, end = region
+    os.mkdir(output_folder)
+    run_mothur_in_folder(
+        "pcr.seqs(fasta={}, taxonomy={}, start={}, end={}, keepdots=F, processors={}, outputdir={}/)".format(
+            os.path.abspath(ref_fasta_fp),
+            os.path.abspath(ref_taxonomy_fp),
+            start,
+            end,
+            threads,
+            output_folder
+        ),
+        output_folder
+    )
+
+    trimmed_fasta_fp = os.path.join(output_folder, os.path.basename(ref_fasta_fp))
+    trimmed_taxonomy_fp = os.path.join(output_folder, os.path.basename(ref_taxonomy_fp))
+    for fp, trimmed_fp in [(ref_fasta_fp, trimmed_fasta_fp), (ref_taxonomy_fp, trimmed_taxonomy_fp)]:
+        root, ext = os.path.splitext(os.path.basename(fp))
+        pcr_fp = os.path.join(output_folder, root + ".pcr" + ext)
+        assert os.path.exists(pcr_fp), "No output from pcr.seqs: " + pcr_fp
+        shutil.move(pcr_fp, trimmed_fp)
+    # Only keep the trimmed reference files
+    for f in os.listdir(output_folder):
+        if f == "mothur.batch" or (f.startswith("mothur") and f.endswith("logfile")):
+            os.remove(os.path.join(output_folder, f))
+
+    build_training_files(
+        trimmed_fasta_fp, trimmed_taxonomy_fp, output_folder, threads=threads
+    )
+
+    return trimmed_fasta_fp, trimmed_taxonomy_fp
+
+
+def get_region_reference(read_fps,
+                         ref_fasta_fp,
+                         ref_taxonomy_fp,
+                         cache_folder,
+                         temp_folder,
+                         region=None,
+                         threads=16,
+                         local_folder=None):
+    """Get a copy of the reference trimmed to the region covered by the reads.
+
+    Trimmed references are cached in `cache_folder` (local path or s3://),
+    keyed by the checksums of the reference files and the region, so that
+    they can be reused by later jobs. If `region` is not given, it is
+    detected from a sample of the reads. Copies fetched from S3 are kept in
+    `local_folder` (default: `temp_folder`), and reused by later calls.
+    Returns (ref_fasta_fp, ref_taxonomy_fp, region).
+    """
+    if not is_aligned_fasta(ref_fasta_fp):
+        logging.info("Reference is not aligned, skipping region trimming")
+        return ref_fasta_fp, ref_taxonomy_fp, None
+
+    if region is None:
+        region = detect_region(read_fps, ref_fasta_fp, temp_folder, threads=threads)
+
+    key = "{}_{}_{}_{}".format(
+        file_checksum(ref_fasta_fp)[:12],
+        file_checksum(ref_taxonomy_fp)[:12],
+        region[0],
+        region[1]
+    )
+    cache_url = cache_folder.rstrip("/") + "/" + key
+
+    if cache_url.startswith("s3://"):
+        if local_folder is None:
+            local_folder = temp_folder
+        local_folder = os.path.abspath(
+            os.path.join(local_folder, "region_reference_" + key)
+        )
+        trimmed_fasta_fp = os.path.join(local_folder, os.path.basename(ref_fasta_fp))
+        trimmed_taxonomy_fp = os.path.join(local_folder, os.path.basename(ref_taxonomy_fp))
+        # The marker is written after the reference files, so that a partial
+        # entry is never used (either locally, or by other jobs on S3)
+        local_marker_fp = os.path.join(local_folder, CACHE_MARKER)
+        marker_url = cache_url + "/" + CACHE_MARKER
+
+        if os.path.exists(local_marker_fp):
+            logging.info("Using local copy of cached reference: " + local_folder)
+            return trimmed_fasta_fp, trimmed_taxonomy_fp, region
+        if os.path.exists(local_folder):
+            shutil.rmtree(local_folder)
+
+        if s3_path_exists(marker_url):
+            logging.info("Fetching cached reference from " + cache_url)
+            run_cmds(["aws", "s3", "sync", "--quiet",
+                      "--exclude", CACHE_MARKER,
+                      cache_url + "/", local_folder])
+            for fp in [trimmed_fasta_fp, trimmed_taxonomy_fp]:
+                assert os.path.exists(fp), "Cached reference is missing " + fp
+            open(local_marker_fp, "wt").close()
+        else:
+            build_region_reference(
+                ref_fasta_fp, ref_taxonomy_fp, region, local_folder, threads=threads
+            )
+            logging.info("Saving reference to cache: " + cache_url)
+            run_cmds(["aws", "s3", "sync", "--quiet",
+                      "--sse", "AES256",
+                      local_folder, cache_url + "/"])
+            open(local_marker_fp, "wt").close()
+            run_cmds(["aws", "s3", "cp", "--quiet",
+                      "--sse", "AES256",
+                      local_marker_fp, marker_url])
+        return trimmed_fasta_fp, trimmed_taxonomy_fp, region
+
+    cache_url = os.path.abspath(cache_url)
+    if not os.path.exists(cache_url):
+        # Build in a temporary folder and then move into place, so that
+        # other jobs never see a partial entry in the cache
+        if not os.path.exists(os.path.dirname(cache_url)):
+            os.makedirs(os.path.dirname(cache_url))
+        build_folder = cache_url + ".tmp." + str(uuid.uuid4())[:8]
+        build_region_reference(
+            ref_fasta_fp, ref_taxonomy_fp, region, build_folder, threads=threads
+        )
+        try:
+            os.rename(build_folder, cache_url)
+        except OSError:
+            # Another job added the same entry to the cache first
+            shutil.rmtree(build_folder)
+    logging.info("Using cached reference from " + cache_url)
+    return (
+        os.path.join(cache_url, os.path.basename(ref_fasta_fp)),
+        os.path.join(cache_url, os.path.basename(ref_taxonomy_fp)),
+        region
+    )
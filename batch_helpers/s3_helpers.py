@@ -8,13 +8,24 @@ from exec_helpers import run_cmds
 from exec_helpers import fastq_to_fasta
 from sra_helpers import get_sra
 
+# A single S3 client is shared by every call in this process
+_s3_client = None
+
+
+def get_s3_client():
+    """Get the S3 client for this process, creating it on first use."""
+    global _s3_client
+    if _s3_client is None:
+        _s3_client = boto3.client('s3')
+    return _s3_client
+
 
 def s3_path_exists(s3_url):
     """Check to see whether a given path exists on S3."""
     logging.info("Checking whether {} already exists on S3".format(s3_url))
     bucket = s3_url[5:].split('/')[0]
     prefix = '/'.join(s3_url[5:].split('/')[1:])
-    client = boto3.client('s3')
+    client = get_s3_client()
     results = client.list_objects(Bucket=bucket, Prefix=prefix)
     if 'Contents' in results:
         logging.info("Output already exists, skipping ({})".format(s3_url))
@@ -22,6 +33,22 @@ def s3_path_exists(s3_url):
     return False
 
 
+def list_s3_folder(s3_url):
+    """List the files directly inside a folder on S3, return a list of URLs."""
+    logging.info("Listing files in {}".format(s3_url))
+    bucket = s3_url[5:].split('/')[0]
+    prefix = '/'.join(s3_url[5:].split('/')[1:])
+    if len(prefix) > 0 and not prefix.endswith('/'):
+        prefix += '/'
+    client = get_s3_client()
+    paginator = client.get_paginator('list_objects')
+    urls = []
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix, Delimiter='/'):
+        for obj in page.get('Contents', []):
+            urls.append("s3://{}/{}".format(bucket, obj['Key']))
+    return urls
+
+
 def get_reads_from_url(input_str, temp_folder):
     """Get a set of reads from a URL -- return the downloaded filepath."""
     logging.info("Getting reads from {}".format(input_str))
@@ -0,0 +1,436 @@
+#!/usr/bin/python
+"""Functions that help with translating results between taxonomies."""
+
+import os
+import re
+import mmap
+import struct
+import logging
+from collections import Counter
+from ref_helpers import file_checksum
+
+# Folder containing the taxonomies bundled with the Docker image
+BUNDLED_DB_FOLDER = "/usr/local/dbs"
+
+# Layout of the compiled taxonomy file:
+#   header: magic, MD5 of the source .tax file, number of nodes, number of
+#           accessions, and the length of the string table
+#   nodes (in depth-first order): parent, end of subtree, name offset and length
+#   accessions (sorted): accession offset and length, node
+#   accessions sorted by node: index into the sorted accessions
+#   string table: each distinct name and accession, stored once
+MAGIC = b"TAXDB001"
+HEADER = struct.Struct("<8s32sIII")
+NODE = struct.Struct("<iIII")
+ACCESSION = struct.Struct("<III")
+INDEX = struct.Struct("<I")
+
+# Translation fails if more than this fraction of the input lineages do not
+# match the source taxonomy (e.g. if the wrong source was given)
+MAX_UNMATCHED_FRACTION = 0.5
+
+# Columns of the summary written by classify.seqs
+SUMMARY_HEADER = ["taxlevel", "rankID", "taxon", "daughterlevels", "total"]
+
+
+def parse_lineage(tax_string):
+    """Split a lineage into a list of names.
+
+    Confidence scores are removed, and unclassified levels are dropped.
+    """
+    names = []
+    for name in tax_string.strip().rstrip(";").split(";"):
+        name = re.sub(r"\(\d+\)$", "", name.strip())
+        if len(name) == 0 or name == "unknown":
+            continue
+        if name == "unclassified" or name.endswith("_unclassified"):
+            break
+        names.append(name)
+    return names
+
+
+def compile_taxonomy(tax_fp, taxdb_fp):
+    """Compile a mothur taxonomy (.tax) file into a TaxonomyStore file."""
+    # Build a trie of the lineages, with the accessions at each node
+    root = ({}, [])
+    with open(tax_fp, "rt") as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if len(line) == 0:
+                continue
+            accession, lineage = line.split("\t")
+            node = root
+            for name in lineage.strip().rstrip(";").split(";"):
+                node = node[0].setdefault(name.strip(), ({}, []))
+            node[1].append(accession)
+
+    # Number the nodes in depth-first order, so that every subtree is a
+    # contiguous range of node IDs
+    nodes = []
+    node_accessions = []
+
+    def add_node(node, name, parent):
+        node_id = len(nodes)
+        nodes.append([parent, None, name])
+        node_accessions.append(node[1])
+        for child_name in sorted(node[0]):
+            add_node(node[0][child_name], child_name, node_id)
+        nodes[node_id][1] = len(nodes)
+
+    add_node(root, "", -1)
+
+    # Intern the names and accessions in a single string table
+    strings = {}
+    string_table = []
+    string_len = [0]
+
+    def intern(s):
+        if s not in strings:
+            encoded = s.encode("utf-8")
+            strings[s] = (string_len[0], len(encoded))
+            string_table.append(encoded)
+            string_len[0] += len(encoded)
+        return strings[s]
+
+    accessions = []
+    for node_id, accs in enumerate(node_accessions):
+        for accession in accs:
+            accessions.append((accession.encode("utf-8"), node_id, accession))
+    accessions.sort()
+    # Accessions sorted by node, as indexes into the sorted list
+    by_node = sorted(range(len(accessions)), key=lambda ix: accessions[ix][1])
+
+    with open(taxdb_fp, "wb") as fo:
+        node_records = [
+            NODE.pack(parent, subtree_end, *intern(name))
+            for parent, subtree_end, name in nodes
+        ]
+        accession_records = [
+            ACCESSION.pack(*(intern(accession) + (node_id,)))
+            for _, node_id, accession in accessions
+        ]
+        fo.write(HEADER.pack(
+            MAGIC,
+            file_checksum(tax_fp).encode("ascii"),
+            len(nodes),
+            len(accessions),
+            string_len[0]
+        ))
+        fo.write(b"".join(node_records))
+        fo.write(b"".join(accession_records))
+        fo.write(b"".join([INDEX.pack(ix) for ix in by_node]))
+        fo.write(b"".join(string_table))
+
+    logging.info("Compiled {:,} accessions and {:,} taxa from {}".format(
+        len(accessions), len(nodes), tax_fp
+    ))
+
+
+class TaxonomyStore(object):
+    """A taxonomy compiled into a trie of names, read from a memory-mapped file.
+
+    Each node in the trie has an integer ID, and the nodes are numbered in
+    depth-first order. Node 0 is the root.
+    """
+
+    def __init__(self, taxdb_fp):
+        self.taxdb_fp = taxdb_fp
+        self._handle = open(taxdb_fp, "rb")
+        self._mm = mmap.mmap(self._handle.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.md5, self.n_nodes, self.n_accessions, string_len = \
+            HEADER.unpack_from(self._mm, 0)
+        assert magic == MAGIC, "Not a compiled taxonomy: " + taxdb_fp
+        self._nodes_offset = HEADER.size
+        self._accessions_offset = self._nodes_offset + self.n_nodes * NODE.size
+        self._by_node_offset = self._accessions_offset + self.n_accessions * ACCESSION.size
+        self._strings_offset = self._by_node_offset + self.n_accessions * INDEX.size
+        assert self._strings_offset + string_len == len(self._mm)
+
+        self._children = {}
+        self._lineages = {}
+
+    @classmethod
+    def load(cls, tax_fp):
+        """Load a .tax file, compiling it first if needed."""
+        taxdb_fp = tax_fp + ".taxdb"
+        if os.path.exists(taxdb_fp):
+            store = cls(taxdb_fp)
+            if store.md5 == file_checksum(tax_fp).encode("ascii"):
+                return store
+            logging.info("Recompiling out-of-date taxonomy: " + taxdb_fp)
+            store.close()
+        # Compile to a temporary file first, so that other processes never
+        # read a partially written file
+        temp_fp = "{}.{}".format(taxdb_fp, os.getpid())
+        compile_taxonomy(tax_fp, temp_fp)
+        os.rename(temp_fp, taxdb_fp)
+        return cls(taxdb_fp)
+
+    def close(self):
+        """Close the memory-mapped file."""
+        self._mm.close()
+        self._handle.close()
+
+    def _string(self, offset, length):
+        start = self._strings_offset + offset
+        return self._mm[start:start + length]
+
+    def _node(self, node_id):
+        return NODE.unpack_from(self._mm, self._nodes_offset + node_id * NODE.size)
+
+    def _accession(self, ix):
+        return ACCESSION.unpack_from(
+            self._mm, self._accessions_offset + ix * ACCESSION.size
+        )
+
+    def _accession_node(self, by_node_ix):
+        ix = INDEX.unpack_from(self._mm, self._by_node_offset + by_node_ix * INDEX.size)[0]
+        return self._accession(ix)[2]
+
+    def name(self, node_id):
+        """Name of a single node."""
+        parent, subtree_end, offset, length = self._node(node_id)
+        return self._string(offset, length).decode("utf-8")
+
+    def parent(self, node_id):
+        """ID of the parent of a node (-1 for the root)."""
+        return self._node(node_id)[0]
+
+    def children(self, node_id):
+        """Dict of name -> node ID for the children of a node."""
+        if node_id not in self._children:
+            children = {}
+            subtree_end = self._node(node_id)[1]
+            child = node_id + 1
+            while child < subtree_end:
+                children[self.name(child)] = child
+                child = self._node(child)[1]
+            self._children[node_id] = children
+        return self._children[node_id]
+
+    def lineage(self, node_id):
+        """List of names from the root down to a node."""
+        if node_id not in self._lineages:
+            names = []
+            ancestor = node_id
+            while ancestor > 0:
+                names.append(self.name(ancestor))
+                ancestor = self.parent(ancestor)
+            self._lineages[node_id] = names[::-1]
+        return self._lineages[node_id]
+
+    def find_lineage(self, names):
+        """ID of the deepest node matching a list of names, starting at the root.
+
+        Returns (node ID, number of names matched).
+        """
+        node_id = 0
+        n_matched = 0
+        for name in names:
+            children = self.children(node_id)
+            if name not in children:
+                break
+            node_id = children[name]
+            n_matched += 1
+        return node_id, n_matched
+
+    def find_accession(self, accession):
+        """ID of the node for an accession, or None if it is not present."""
+        accession = accession.encode("utf-8")
+        lo, hi = 0, self.n_accessions
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset, length, node_id = self._accession(mid)
+            value = self._string(offset, length)
+            if value == accession:
+                return node_id
+            elif value < accession:
+                lo = mid + 1
+            else:
+                hi = mid
+        return None
+
+    def subtree_accessions(self, node_id):
+        """List of the accessions assigned to a node or any of its descendants."""
+        subtree_end = self._node(node_id)[1]
+
+        def first_at_or_after(target):
+            lo, hi = 0, self.n_accessions
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self._accession_node(mid) < target:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            return lo
+
+        accessions = []
+        for by_node_ix in range(first_at_or_after(node_id), first_at_or_after(subtree_end)):
+            ix = INDEX.unpack_from(self._mm, self._by_node_offset + by_node_ix * INDEX.size)[0]
+            offset, length, _ = self._accession(ix)
+            accessions.append(self._string(offset, length).decode("utf-8"))
+        return accessions
+
+
+def taxonomy_name(tax_fp):
+    """Short name for a taxonomy file, e.g. 'gg' for silva.bacteria.gg.tax."""
+    return os.path.basename(tax_fp)[:-len(".tax")].split(".")[-1]
+
+
+def load_bundled_taxonomies(folder=BUNDLED_DB_FOLDER):
+    """Load every .tax file in a folder, return a dict of name -> TaxonomyStore."""
+    stores = {}
+    for f in sorted(os.listdir(folder)):
+        if f.endswith(".tax"):
+            stores[taxonomy_name(f)] = TaxonomyStore.load(os.path.join(folder, f))
+    logging.info("Loaded taxonomies: " + ", ".join(sorted(stores)))
+    return stores
+
+
+class TaxonomyTranslator(object):
+    """Project lineages from one taxonomy onto another via shared accessions.
+
+    A lineage is matched to its node in the source taxonomy, and the
+    accessions under that node are looked up in the target taxonomy. The
+    result is the consensus of their target lineages, down to the level
+    where fewer than `min_agreement` percent of the accessions agree (as
+    with the cutoff of classify.seqs).
+    """
+
+    def __init__(self, source, target, min_agreement=80):
+        self.source = source
+        self.target = target
+        self.min_agreement = min_agreement
+        self._cache = {}
+        # Number of lineages translated, and how many of them were not
+        # fully matched in the source taxonomy (and were truncated)
+        self.n_translated = 0
+        self.n_unmatched = 0
+
+    def translate(self, tax_string):
+        """Translate a lineage, return it formatted as in classify.seqs."""
+        names = tuple(parse_lineage(tax_string))
+        if names not in self._cache:
+            source_node, n_matched = self.source.find_lineage(names)
+            self._cache[names] = (
+                self._project(source_node), n_matched == len(names)
+            )
+        translated, matched = self._cache[names]
+        self.n_translated += 1
+        if not matched:
+            self.n_unmatched += 1
+        return translated
+
+    def check_unmatched(self, n_translated, n_unmatched, label):
+        """Log the lineages not matched since the counts were taken, fail if too many."""
+        n_translated = self.n_translated - n_translated
+        n_unmatched = self.n_unmatched - n_unmatched
+        if n_unmatched == 0:
+            return
+        logging.info(
+            "{:,} of {:,} lineages in {} did not match the source taxonomy, "
+            "and were truncated to their deepest match".format(
+                n_unmatched, n_translated, label
+            )
+        )
+        msg = "Most lineages in {} do not match the source taxonomy".format(label)
+        assert n_unmatched <= MAX_UNMATCHED_FRACTION * n_translated, msg
+
+    def _project(self, source_node):
+        lineages = []
+        for accession in self.source.subtree_accessions(source_node):
+            target_node = self.target.find_accession(accession)
+            if target_node is not None:
+                lineages.append(self.target.lineage(target_node))
+        if len(lineages) == 0:
+            return "unknown;"
+
+        consensus, agreements = [], []
+        for level in range(max([len(lineage) for lineage in lineages])):
+            counts = Counter([
+                lineage[level] for lineage in lineages
+                if len(lineage) > level and lineage[:level] == consensus
+            ])
+            if len(counts) == 0:
+                break
+            name, n = counts.most_common(1)[0]
+            agreement = 100 * n // len(lineages)
+            if agreement < self.min_agreement:
+                break
+            consensus.append(name)
+            agreements.append(agreement)
+
+        if len(consensus) == 0:
+            return "unknown;"
+        return "".join([
+            "{}({});".format(name, agreement)
+            for name, agreement in zip(consensus, agreements)
+        ])
+
+
+def summarize_taxonomy(tax_strings):
+    """Count the number of reads assigned to each taxon.
+
+    Returns a list of rows, each a dict keyed by SUMMARY_HEADER, in the
+    same layout as the .tax.summary written by classify.seqs.
+    """
+    root = [{}, 0]
+    for tax_string in tax_strings:
+        root[1] += 1
+        node = root
+        for name in parse_lineage(tax_string):
+            node = node[0].setdefault(name, [{}, 0])
+            node[1] += 1
+
+    rows = []
+
+    def add_row(node, name, taxlevel, rank_id):
+        rows.append(dict(zip(SUMMARY_HEADER, [
+            str(taxlevel), rank_id, name, str(len(node[0])), str(node[1])
+        ])))
+        for ix, child_name in enumerate(sorted(node[0])):
+            add_row(
+                node[0][child_name],
+                child_name,
+                taxlevel + 1,
+                "{}.{}".format(rank_id, ix + 1)
+            )
+
+    add_row(root, "Root", 0, "0")
+    return rows
+
+
+def translate_taxonomy_file(taxonomy_fp, output_fp, summary_fp, translator):
+    """Translate a .taxonomy file from classify.seqs, and write a new summary."""
+    tax_strings = []
+    counts = (translator.n_translated, translator.n_unmatched)
+    with open(taxonomy_fp, "rt") as f, open(output_fp, "wt") as fo:
+        for line in f:
+            header, tax_string = line.rstrip("\n").split("\t")
+            tax_string = translator.translate(tax_string)
+            fo.write("{}\t{}\n".format(header, tax_string))
+            tax_strings.append(tax_string)
+    translator.check_unmatched(counts[0], counts[1], taxonomy_fp)
+
+    with open(summary_fp, "wt") as fo:
+        fo.write("\t".join(SUMMARY_HEADER) + "\n")
+        for row in summarize_taxonomy(tax_strings):
+            fo.write("\t".join([row[k] for k in SUMMARY_HEADER]) + "\n")
+
+
+def translate_results(results, translator):
+    """Translate the output of run_classify_seqs.py, return a new results object."""
+    counts = (translator.n_translated, translator.n_unmatched)
+    read_level = [
+        {
+            "header": r["header"],
+            "taxonomy": translator.translate(r["taxonomy"])
+        }
+        for r in results["read_level"]
+    ]
+    translator.check_unmatched(counts[0], counts[1], "the results")
+    return {
+        "read_level": read_level,
+        "summary": summarize_taxonomy([r["taxonomy"] for r in read_level]),
+        "metadata": results.get("metadata", {})
+    }
@@ -0,0 +1,178 @@
+#!/usr/bin/python
+"""Functions that help with running samples from a queue stored in SQLite."""
+
+import json
+import time
+import logging
+import sqlite3
+import threading
+
+SCHEMA = """CREATE TABLE IF NOT EXISTS samples (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    sample_name TEXT NOT NULL,
+    descriptor TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    lease_expires REAL,
+    enqueued_at REAL,
+    started_at REAL,
+    finished_at REAL,
+    elapsed REAL,
+    timings TEXT,
+    error TEXT
+)"""
+
+# Status of each sample in the queue
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class WorkQueue(object):
+    """A durable queue of samples, shared by any number of workers.
+
+    Each sample is described by a dict (stored as JSON). Workers lease a
+    sample for a limited time, and must renew the lease while they are
+    working on it. If a worker stops without finishing a sample, the lease
+    expires and the sample is run again, up to `max_attempts` times.
+    """
+
+    def __init__(self, queue_fp, max_attempts=3):
+        self.queue_fp = queue_fp
+        self.max_attempts = max_attempts
+        # Transactions are started explicitly, see _transaction()
+        self._db = sqlite3.connect(queue_fp, timeout=60, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(SCHEMA)
+
+    def close(self):
+        """Close the connection to the queue."""
+        self._db.close()
+
+    def _transaction(self, statements):
+        """Run a list of (sql, params) in a single write transaction."""
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            results = [self._db.execute(sql, params) for sql, params in statements]
+            self._db.execute("COMMIT")
+        except Exception:
+            self._db.execute("ROLLBACK")
+            raise
+        return results
+
+    def enqueue(self, descriptor):
+        """Add a sample to the queue, return its ID."""
+        cursor, = self._transaction([(
+            "INSERT INTO samples (sample_name, descriptor, enqueued_at) VALUES (?, ?, ?)",
+            (descriptor["sample_name"], json.dumps(descriptor), time.time())
+        )])
+        return cursor.lastrowid
+
+    def lease(self, worker, lease_seconds):
+        """Lease the next sample to be run, return (ID, descriptor) or None."""
+        now = time.time()
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            # Give up on samples which have expired too many times
+            self._db.execute(
+                """UPDATE samples SET status = ?, error = ?, finished_at = ?
+                   WHERE status = ? AND lease_expires < ? AND attempts >= ?""",
+                (FAILED, "Lease expired", now, RUNNING, now, self.max_attempts)
+            )
+            row = self._db.execute(
+                """SELECT id, descriptor FROM samples
+                   WHERE status = ? OR (status = ? AND lease_expires < ?)
+                   ORDER BY id LIMIT 1""",
+                (PENDING, RUNNING, now)
+            ).fetchone()
+            if row is not None:
+                self._db.execute(
+                    """UPDATE samples
+                       SET status = ?, attempts = attempts + 1, worker = ?,
+                           lease_expires = ?, started_at = ?, error = NULL
+                       WHERE id = ?""",
+                    (RUNNING, worker, now + lease_seconds, now, row[0])
+                )
+            self._db.execute("COMMIT")
+        except Exception:
+            self._db.execute("ROLLBACK")
+            raise
+
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+    def renew(self, sample_id, worker, lease_seconds):
+        """Extend the lease on a sample, return False if it was lost."""
+        cursor, = self._transaction([(
+            "UPDATE samples SET lease_expires = ? WHERE id = ? AND worker = ? AND status = ?",
+            (time.time() + lease_seconds, sample_id, worker, RUNNING)
+        )])
+        return cursor.rowcount == 1
+
+    def complete(self, sample_id, worker, timings):
+        """Mark a sample as done, recording the time taken by each step."""
+        now = time.time()
+        self._transaction([(
+            """UPDATE samples
+               SET status = ?, finished_at = ?, elapsed = ? - started_at, timings = ?
+               WHERE id = ? AND worker = ?""",
+            (DONE, now, now, json.dumps(timings), sample_id, worker)
+        )])
+
+    def fail(self, sample_id, worker, error, timings=None):
+        """Record an error for a sample, which is retried up to `max_attempts` times."""
+        now = time.time()
+        self._transaction([(
+            """UPDATE samples
+               SET status = CASE WHEN attempts < ? THEN ? ELSE ? END,
+                   finished_at = ?, elapsed = ? - started_at, timings = ?, error = ?
+               WHERE id = ? AND worker = ?""",
+            (self.max_attempts, PENDING, FAILED, now, now,
+             json.dumps(timings or {}), error, sample_id, worker)
+        )])
+
+    def counts(self):
+        """Number of samples with each status."""
+        return dict(self._db.execute(
+            "SELECT status, COUNT(*) FROM samples GROUP BY status"
+        ).fetchall())
+
+    def samples(self):
+        """List of dicts describing the status of every sample."""
+        cursor = self._db.execute(
+            """SELECT id, sample_name, status, attempts, worker, elapsed, timings, error
+               FROM samples ORDER BY id"""
+        )
+        columns = [c[0] for c in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+class LeaseHeartbeat(threading.Thread):
+    """Renew the lease on a sample in the background until stopped."""
+
+    def __init__(self, queue_fp, sample_id, worker, lease_seconds):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.queue_fp = queue_fp
+        self.sample_id = sample_id
+        self.worker = worker
+        self.lease_seconds = lease_seconds
+        self._stop_event = threading.Event()
+
+    def run(self):
+        # SQLite connections cannot be shared between threads
+        queue = WorkQueue(self.queue_fp)
+        try:
+            while not self._stop_event.wait(self.lease_seconds / 3.):
+                if not queue.renew(self.sample_id, self.worker, self.lease_seconds):
+                    logging.info("Lost the lease on sample {}".format(self.sample_id))
+                    break
+        finally:
+            queue.close()
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
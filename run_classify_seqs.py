@@ -8,10 +8,13 @@ import logging
 import argparse
 from exec_helpers import run_cmds
 from exec_helpers import fastq_to_fasta
+from exec_helpers import subsample_fasta
 from exec_helpers import return_results
 from s3_helpers import get_file
 from s3_helpers import s3_path_exists
 from s3_helpers import get_reads_from_url
+from ref_helpers import parse_region
+from ref_helpers import get_region_reference
 
 
 def classify_seqs(input_str,
@@ -24,8 +27,21 @@ def classify_seqs(input_str,
                   threads=16,
                   temp_folder='/scratch',
                   ksize=8,
-                  iters=100):
-    """Classify a set of reads with mothur.classify.seqs."""
+                  iters=100,
+                  max_reads=None,
+                  seed=0,
+                  ref_region_cache=None,
+                  region=None,
+                  log_fp=None,
+                  region_folder=None):
+    """Classify a set of reads with mothur.classify.seqs.
+
+    If `ref_region_cache` is set, the reference is trimmed to the region
+    of the alignment covered by the reads (or `region`, if given), and
+    cached for use by later jobs. Local copies of the trimmed reference
+    are kept in `region_folder` (default: `temp_folder`). The contents of
+    `log_fp` are included in the output metadata.
+    """
 
     # Use the read prefix to name the output and temporary files
     read_prefix = input_str.split('/')[-1]
@@ -64,11 +80,17 @@ def classify_seqs(input_str,
         run_cmds(["gunzip", "-f", read_fp])
         read_fp = read_fp.replace(".gz", "")
 
+    # Number of reads before and after subsampling (if known)
+    n_reads_input, n_reads_sampled = None, None
+
     # If the reads are in FASTQ format, convert to FASTA
+    # (subsampling to `max_reads` in the same pass, if set)
     for ending in [".fq", ".fastq"]:
         if read_fp.endswith(ending):
             new_fp = read_fp.replace(ending, ".fasta")
-            fastq_to_fasta(read_fp, new_fp)
+            n_reads_input, n_reads_sampled = fastq_to_fasta(
+                read_fp, new_fp, max_reads=max_reads, seed=seed
+            )
             read_fp = new_fp
 
     # If the reads have non-standard FASTA suffixes, correct them
@@ -81,6 +103,27 @@ def classify_seqs(input_str,
     # Make sure that it ends with ".fasta"
     assert read_fp.endswith(".fasta")
 
+    # Subsample FASTA inputs which were not converted from FASTQ
+    if max_reads is not None and n_reads_input is None:
+        new_fp = read_fp.replace(".fasta", ".subsampled.fasta")
+        n_reads_input, n_reads_sampled = subsample_fasta(
+            read_fp, new_fp, max_reads, seed=seed
+        )
+        read_fp = new_fp
+
+    # Trim the reference to the region covered by the reads
+    if ref_region_cache is not None:
+        ref_fasta_fp, ref_taxonomy_fp, region = get_region_reference(
+            [read_fp],
+            ref_fasta_fp,
+            ref_taxonomy_fp,
+            ref_region_cache,
+            temp_folder,
+            region=region,
+            threads=threads,
+            local_folder=region_folder
+        )
+
     # Write out a batchfile for mothur to use
     batchfile_fp = os.path.join(temp_folder, "batchfile")
     with open(batchfile_fp, "wt") as fo:
@@ -104,8 +147,10 @@ def classify_seqs(input_str,
     output = parse_classify_seqs_output(output_per_read, output_summary)
 
     # Read in the logs
-    logging.info("Reading in the logs")
-    logs = open(log_fp, 'rt').readlines()
+    logs = []
+    if log_fp is not None:
+        logging.info("Reading in the logs")
+        logs = open(log_fp, 'rt').readlines()
 
     # Add more metadata to the results object
     output["metadata"] = {
@@ -115,13 +160,35 @@ def classify_seqs(input_str,
         "output_folder": output_folder,
         "logs": logs,
         "ref_fasta_url": ref_fasta_url,
-        "ref_tax_url": ref_taxonomy_url
+        "ref_tax_url": ref_taxonomy_url,
+        "max_reads": max_reads,
+        "seed": seed,
+        "n_reads_input": n_reads_input,
+        "n_reads_sampled": n_reads_sampled,
+        "ref_region": region
     }
 
     # Write out the final results as JSON and copy to the output folder
     return_results(output, sample_name, output_folder, temp_folder)
 
 
+def stage_reference(ref_fasta, ref_taxonomy, temp_folder):
+    """Get the reference database files, return the local paths."""
+    # Make sure that the reference files have controlled endings
+    assert ref_fasta.endswith((".fasta", ".fasta.gz"))
+
+    # Get the reference database files
+    ref_fasta_fp = get_file(ref_fasta, temp_folder)
+    ref_taxonomy_fp = get_file(ref_taxonomy, temp_folder)
+
+    # Decompress the reference FASTA if necessary
+    if ref_fasta_fp.endswith(".gz"):
+        run_cmds(["gunzip", "-k", "-f", ref_fasta_fp])
+        ref_fasta_fp = ref_fasta_fp[:-3]
+
+    return ref_fasta_fp, ref_taxonomy_fp
+
+
 def parse_classify_seqs_output(output_per_read, output_summary):
     """Parse a set of results from the mothur classify.seqs command."""
     output = {
@@ -198,6 +265,27 @@ if __name__ == "__main__":
                         type=str,
                         default='/scratch',
                         help="Folder used for temporary files.")
+    parser.add_argument("--max-reads",
+                        type=int,
+                        default=None,
+                        help="""Randomly subsample the input to at most this
+                                many reads before classification.""")
+    parser.add_argument("--seed",
+                        type=int,
+                        default=0,
+                        help="Random seed used for subsampling.")
+    parser.add_argument("--ref-region-cache",
+                        type=str,
+                        default=None,
+                        help="""Folder used to cache copies of the reference
+                                trimmed to the region covered by the reads.
+                                (Supported: s3://, or local path).""")
+    parser.add_argument("--region",
+                        type=parse_region,
+                        default=None,
+                        help="""Region of the reference alignment to use, as
+                                START:END (default: detect from the reads).
+                                Only used with --ref-region-cache.""")
 
     args = parser.parse_args()
 
@@ -222,17 +310,10 @@ if __name__ == "__main__":
     consoleHandler.setFormatter(logFormatter)
     rootLogger.addHandler(consoleHandler)
 
-    # Make sure that the reference files have controlled endings
-    assert args.ref_fasta.endswith((".fasta", ".fasta.gz"))
-
     # Get the reference database files
-    ref_fasta_fp = get_file(args.ref_fasta, temp_folder)
-    ref_taxonomy_fp = get_file(args.ref_taxonomy, temp_folder)
-
-    # Decompress the reference FASTA if necessary
-    if ref_fasta_fp.endswith(".gz"):
-        run_cmds(["gunzip", "-k", "-f", ref_fasta_fp])
-        ref_fasta_fp = ref_fasta_fp[:-3]
+    ref_fasta_fp, ref_taxonomy_fp = stage_reference(
+        args.ref_fasta, args.ref_taxonomy, temp_folder
+    )
 
     # Align each of the inputs and calculate the overall abundance
     logging.info("Processing input: " + args.input)
@@ -246,7 +327,12 @@ if __name__ == "__main__":
             args.ref_taxonomy,      # URL for reference taxonomy
             args.output_folder,     # Place to put results
             threads=args.threads,
-            temp_folder=temp_folder
+            temp_folder=temp_folder,
+            max_reads=args.max_reads,
+            seed=args.seed,
+            ref_region_cache=args.ref_region_cache,
+            region=args.region,
+            log_fp=log_fp
         )
     except:
         # Make sure to delete the temporary folder if there's a failure
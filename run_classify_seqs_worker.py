@@ -0,0 +1,355 @@
+#!/usr/bin/python
+"""Long-running worker to run classify.seqs on samples from a queue."""
+
+import os
+import json
+import time
+import uuid
+import shutil
+import socket
+import logging
+import argparse
+import traceback
+from work_queue import WorkQueue
+from work_queue import LeaseHeartbeat
+from ref_helpers import parse_region
+from run_classify_seqs import classify_seqs
+from run_classify_seqs import stage_reference
+
+LOG_FORMAT = '%(asctime)s %(levelname)-8s [mothur.classify.seqs] %(message)s'
+
+
+# Options which hold a local path or URL
+PATH_OPTIONS = ["input", "ref_fasta", "ref_taxonomy", "output_folder", "ref_region_cache"]
+
+
+def absolute_path(path):
+    """Make a local path absolute (keeping any trailing slash), leaving URLs as-is."""
+    if path is None or path.startswith(('s3://', 'sra://', 'ftp://', 'https://', 'http://')):
+        return path
+    if path.endswith("/"):
+        return os.path.abspath(path) + "/"
+    return os.path.abspath(path)
+
+
+def enqueue_samples(queue_fp, samples, **options):
+    """Add a list of (input, sample_name) to the queue, with shared options.
+
+    Local paths are stored as absolute paths, since workers run each
+    sample from within its own temporary folder.
+    """
+    queue = WorkQueue(queue_fp)
+    for input_str, sample_name in samples:
+        descriptor = dict(options)
+        descriptor["input"] = input_str
+        descriptor["sample_name"] = sample_name
+        for key in PATH_OPTIONS:
+            descriptor[key] = absolute_path(descriptor.get(key))
+        sample_id = queue.enqueue(descriptor)
+        logging.info("Added {} to the queue ({})".format(sample_name, sample_id))
+    queue.close()
+
+
+def run_sample(queue, sample_id, descriptor, worker, worker_folder,
+               references, threads=16, lease_seconds=600):
+    """Run classify.seqs for a single sample from the queue, and record the outcome.
+
+    The reference files are only staged the first time they are used, and
+    are kept in `references` for the following samples. Trimmed references
+    (with --ref-region-cache) are kept in `worker_folder`, and reused by
+    later samples with the same reference and region.
+    """
+    logging.info("Starting sample {} ({})".format(
+        sample_id, descriptor["sample_name"]
+    ))
+    heartbeat = LeaseHeartbeat(queue.queue_fp, sample_id, worker, lease_seconds)
+    heartbeat.start()
+
+    # Keep everything for this sample (including the mothur logfile, which
+    # is written to the working directory) in a folder of its own
+    sample_folder = os.path.join(worker_folder, "sample_{}".format(sample_id))
+    os.mkdir(sample_folder)
+    working_dir = os.getcwd()
+    os.chdir(sample_folder)
+
+    # Capture the logs for this sample, to include in its output
+    log_fp = os.path.join(sample_folder, "log.txt")
+    fileHandler = logging.FileHandler(log_fp)
+    fileHandler.setFormatter(logging.Formatter(LOG_FORMAT))
+    logging.getLogger().addHandler(fileHandler)
+
+    timings = {}
+    error = None
+    start_time = time.time()
+    try:
+        key = (descriptor["ref_fasta"], descriptor["ref_taxonomy"])
+        if key not in references:
+            ref_folder = os.path.join(worker_folder, "ref_{}".format(len(references)))
+            os.mkdir(ref_folder)
+            references[key] = stage_reference(key[0], key[1], ref_folder)
+        ref_fasta_fp, ref_taxonomy_fp = references[key]
+        timings["stage_reference"] = time.time() - start_time
+
+        region = descriptor.get("region")
+        classify_seqs(
+            descriptor["input"],
+            descriptor["sample_name"],
+            ref_fasta_fp,
+            descriptor["ref_fasta"],
+            ref_taxonomy_fp,
+            descriptor["ref_taxonomy"],
+            descriptor["output_folder"],
+            threads=threads,
+            temp_folder=sample_folder,
+            max_reads=descriptor.get("max_reads"),
+            seed=descriptor.get("seed", 0),
+            ref_region_cache=descriptor.get("ref_region_cache"),
+            region=tuple(region) if region is not None else None,
+            log_fp=log_fp,
+            region_folder=worker_folder
+        )
+        timings["classify_seqs"] = time.time() - start_time - timings["stage_reference"]
+    except Exception:
+        error = traceback.format_exc()
+        logging.info("Error processing sample {}:\n{}".format(sample_id, error))
+    finally:
+        heartbeat.stop()
+        os.chdir(working_dir)
+        logging.getLogger().removeHandler(fileHandler)
+        fileHandler.close()
+        shutil.rmtree(sample_folder)
+
+    if error is None:
+        queue.complete(sample_id, worker, timings)
+        logging.info("Finished sample {} in {:.1f} seconds".format(
+            sample_id, time.time() - start_time
+        ))
+    else:
+        queue.fail(sample_id, worker, error, timings)
+
+
+def run_worker(queue_fp,
+               temp_folder='/scratch',
+               threads=16,
+               lease_seconds=600,
+               idle_timeout=60,
+               poll_interval=5,
+               max_attempts=3):
+    """Run samples from the queue until it has been empty for `idle_timeout` seconds."""
+    queue_fp = os.path.abspath(queue_fp)
+    worker = "{}:{}".format(socket.gethostname(), os.getpid())
+    logging.info("Starting worker {} for {}".format(worker, queue_fp))
+
+    # Make a temporary folder for this worker, which holds the references
+    worker_folder = os.path.abspath(os.path.join(temp_folder, str(uuid.uuid4())[:8]))
+    assert os.path.exists(worker_folder) is False
+    os.mkdir(worker_folder)
+
+    queue = WorkQueue(queue_fp, max_attempts=max_attempts)
+    references = {}
+    n_samples = 0
+    idle_since = time.time()
+    try:
+        while True:
+            item = queue.lease(worker, lease_seconds)
+            if item is None:
+                if time.time() - idle_since > idle_timeout:
+                    logging.info("Queue is empty, stopping")
+                    break
+                time.sleep(poll_interval)
+                continue
+
+            sample_id, descriptor = item
+            run_sample(
+                queue,
+                sample_id,
+                descriptor,
+                worker,
+                worker_folder,
+                references,
+                threads=threads,
+                lease_seconds=lease_seconds
+            )
+            n_samples += 1
+            idle_since = time.time()
+    finally:
+        queue.close()
+        # Delete everything in the temporary folder
+        logging.info("Deleting temporary folder {}".format(worker_folder))
+        shutil.rmtree(worker_folder)
+
+    logging.info("Processed {:,} samples".format(n_samples))
+
+
+def print_status(queue_fp):
+    """Print the status of every sample in the queue."""
+    queue = WorkQueue(queue_fp)
+    print("\t".join(["id", "sample_name", "status", "attempts", "worker", "elapsed", "timings", "error"]))
+    for sample in queue.samples():
+        error = sample["error"]
+        if error:
+            # Only show the last line of the traceback
+            error = error.strip().split("\n")[-1]
+        print("\t".join([str(v) for v in [
+            sample["id"],
+            sample["sample_name"],
+            sample["status"],
+            sample["attempts"],
+            sample["worker"],
+            "{:.1f}".format(sample["elapsed"]) if sample["elapsed"] is not None else None,
+            sample["timings"],
+            error
+        ]]))
+    print(json.dumps(queue.counts()))
+    queue.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="""
+    Run the classify.seqs command within mothur for samples from a queue.
+    """)
+    subparsers = parser.add_subparsers(dest="command")
+
+    enqueue = subparsers.add_parser("enqueue", help="Add samples to the queue.")
+    enqueue.add_argument("--queue",
+                         type=str,
+                         required=True,
+                         help="Queue file (SQLite), created if needed.")
+    enqueue.add_argument("--input",
+                         type=str,
+                         help="""Location for input file(s).
+                                 (Supported: sra://, s3://, or ftp://).""")
+    enqueue.add_argument("--sample-name",
+                         type=str,
+                         help="""Sample name.""")
+    enqueue.add_argument("--manifest",
+                         type=str,
+                         help="""Tab-delimited file with the input and sample
+                                 name for each sample (instead of --input and
+                                 --sample-name).""")
+    enqueue.add_argument("--ref-fasta",
+                         type=str,
+                         required=True,
+                         help="""Reference FASTA file.
+                                 (Supported: s3://, ftp://, or local path).""")
+    enqueue.add_argument("--ref-taxonomy",
+                         type=str,
+                         required=True,
+                         help="""Reference taxonomy file.
+                                 (Supported: s3://, ftp://, or local path).""")
+    enqueue.add_argument("--output-folder",
+                         type=str,
+                         required=True,
+                         help="""Folder to place results.
+                                 (Supported: s3://, or local path).""")
+    enqueue.add_argument("--max-reads",
+                         type=int,
+                         default=None,
+                         help="""Randomly subsample the input to at most this
+                                 many reads before classification.""")
+    enqueue.add_argument("--seed",
+                         type=int,
+                         default=0,
+                         help="Random seed used for subsampling.")
+    enqueue.add_argument("--ref-region-cache",
+                         type=str,
+                         default=None,
+                         help="""Folder used to cache copies of the reference
+                                 trimmed to the region covered by the reads.
+                                 (Supported: s3://, or local path).""")
+    enqueue.add_argument("--region",
+                         type=parse_region,
+                         default=None,
+                         help="""Region of the reference alignment to use, as
+                                 START:END (default: detect from the reads).
+                                 Only used with --ref-region-cache.""")
+
+    work = subparsers.add_parser("work", help="Run samples from the queue.")
+    work.add_argument("--queue",
+                      type=str,
+                      required=True,
+                      help="Queue file (SQLite).")
+    work.add_argument("--threads",
+                      type=int,
+                      default=16,
+                      help="Number of threads to use.")
+    work.add_argument("--temp-folder",
+                      type=str,
+                      default='/scratch',
+                      help="Folder used for temporary files.")
+    work.add_argument("--lease-seconds",
+                      type=int,
+                      default=600,
+                      help="""Time after which a sample is run again if the
+                              worker stops renewing its lease.""")
+    work.add_argument("--idle-timeout",
+                      type=int,
+                      default=60,
+                      help="Stop after the queue has been empty for this long.")
+    work.add_argument("--poll-interval",
+                      type=int,
+                      default=5,
+                      help="Seconds to wait between checks of an empty queue.")
+    work.add_argument("--max-attempts",
+                      type=int,
+                      default=3,
+                      help="Number of times to try each sample.")
+
+    status = subparsers.add_parser("status", help="Show the status of each sample.")
+    status.add_argument("--queue",
+                        type=str,
+                        required=True,
+                        help="Queue file (SQLite).")
+
+    args = parser.parse_args()
+
+    # Set up logging
+    logFormatter = logging.Formatter(LOG_FORMAT)
+    rootLogger = logging.getLogger()
+    rootLogger.setLevel(logging.INFO)
+    # Write to STDOUT
+    consoleHandler = logging.StreamHandler()
+    consoleHandler.setFormatter(logFormatter)
+    rootLogger.addHandler(consoleHandler)
+
+    if args.command == "enqueue":
+        if args.manifest is not None:
+            with open(args.manifest, "rt") as f:
+                samples = [
+                    line.rstrip("\n").split("\t")[:2]
+                    for line in f if len(line.strip()) > 0
+                ]
+        else:
+            msg = "Specify either --manifest, or --input and --sample-name"
+            assert args.input is not None and args.sample_name is not None, msg
+            samples = [(args.input, args.sample_name)]
+        enqueue_samples(
+            args.queue,
+            samples,
+            ref_fasta=args.ref_fasta,
+            ref_taxonomy=args.ref_taxonomy,
+            output_folder=args.output_folder,
+            max_reads=args.max_reads,
+            seed=args.seed,
+            ref_region_cache=args.ref_region_cache,
+            region=args.region
+        )
+
+    elif args.command == "work":
+        run_worker(
+            args.queue,
+            temp_folder=args.temp_folder,
+            threads=args.threads,
+            lease_seconds=args.lease_seconds,
+            idle_timeout=args.idle_timeout,
+            poll_interval=args.poll_interval,
+            max_attempts=args.max_attempts
+        )
+
+    elif args.command == "status":
+        print_status(args.queue)
+
+    else:
+        parser.print_help()
+
+    logging.shutdown()
@@ -8,8 +8,40 @@ import shutil
 import logging
 import argparse
 import datetime
+import multiprocessing
 from Bio.SeqIO.QualityIO import FastqGeneralIterator
 from exec_helpers import run_cmds
+from exec_helpers import reservoir_sample
+from s3_helpers import list_s3_folder
+from cluster_helpers import run_cluster_stage
+from ref_helpers import parse_region
+from ref_helpers import get_region_reference
+
+# Steps of the MiSeq SOP which are run independently for each sample
+# (contig assembly, screening, dereplication and alignment)
+PREPROCESS_COMMANDS = """make.contigs(file={manifest_fp}, processors={threads})
+screen.seqs(fasta=current, group=current, maxambig=0, maxlength=275)
+unique.seqs()
+count.seqs(name=current, group=current)
+align.seqs(fasta=current, reference={temp_db_fasta})"""
+
+# Steps of the MiSeq SOP which are run on all of the samples together
+CLASSIFY_COMMANDS = """unique.seqs(fasta={fasta}, count={count})
+pre.cluster(fasta=current, count=current, diffs=2)
+classify.seqs(fasta=current, count=current, reference={temp_db_fasta}, taxonomy={temp_db_tax}, cutoff=80)"""
+CLUSTER_COMMANDS = """cluster.split(fasta=current, count=current, taxonomy=current, splitmethod=classify, taxlevel=4, cutoff=0.15)
+classify.otu(list=current, count=current, taxonomy=current, label=0.03)
+phylotype(taxonomy=current)
+make.shared(list=current, count=current, label=1)"""
+
+# Steps following clustering within a memory budget (see cluster_helpers)
+BOUNDED_CLUSTER_COMMANDS = """classify.otu(list={list_fp}, count={count_fp}, taxonomy={taxonomy_fp}, label=0.03)
+phylotype(taxonomy={taxonomy_fp})
+make.shared(list=current, count=current, label=1)"""
+
+# Outputs of PREPROCESS_COMMANDS, named by mothur from the manifest prefix
+ALIGN_SUFFIX = ".trim.contigs.good.unique.align"
+COUNT_SUFFIX = ".trim.contigs.good.count_table"
 
 
 def gzip_safe_open(fp):
@@ -19,8 +51,23 @@ def gzip_safe_open(fp):
         return open(fp, "rt")
 
 
-def try_splitting_fastq_file(file_path):
-    """Try splitting a file into R1 and R2, return None if not possible."""
+def iter_fastq_pairs(handle):
+    """Yield pairs of records from an interleaved FASTQ file."""
+    records = FastqGeneralIterator(handle)
+    for r1 in records:
+        r2 = next(records, None)
+        if r2 is None:
+            logging.info("Skipping unpaired final read: " + r1[0])
+            break
+        yield r1, r2
+
+
+def try_splitting_fastq_file(file_path, max_pairs=None, seed=0):
+    """Try splitting a file into R1 and R2, return None if not possible.
+
+    If max_pairs is set, a random subset of at most that many pairs is kept.
+    Returns (r1_fp, r2_fp, n_pairs_input, n_pairs_output).
+    """
     assert os.path.exists(file_path)
 
     # Test to see if the file could be a FASTQ
@@ -32,66 +79,408 @@ def try_splitting_fastq_file(file_path):
 
     # Open a handle for the input
     f = gzip_safe_open(file_path)
-    
+
+    # Subsample pairs of reads, if specified, keeping mates together
+    pairs = iter_fastq_pairs(f)
+    if max_pairs is not None:
+        pairs, n_pairs_input = reservoir_sample(pairs, max_pairs, seed=seed)
+
     # Open handles for the output
     r1_fp = file_path + ".R1.fastq"
     r2_fp = file_path + ".R2.fastq"
     r1 = open(r1_fp, "wt")
     r2 = open(r2_fp, "wt")
 
-    ix = 0
-    for header, seq, qual in FastqGeneralIterator(f):
-        if ix % 2 == 0:
-            r1.write("@{}\n{}\n+{}\n{}\n".format(
-                header, seq, header, qual
-            ))
-        else:
-            r2.write("@{}\n{}\n+{}\n{}\n".format(
-                header, seq, header, qual
-            ))
-        ix += 1
+    n_pairs = 0
+    for (h1, s1, q1), (h2, s2, q2) in pairs:
+        r1.write("@{}\n{}\n+{}\n{}\n".format(
+            h1, s1, h1, q1
+        ))
+        r2.write("@{}\n{}\n+{}\n{}\n".format(
+            h2, s2, h2, q2
+        ))
+        n_pairs += 1
 
     # Close all of the handles
     r1.close()
     r2.close()
     f.close()
 
-    logging.info("Split {} into {:,} pairs of reads".format(file_path, ix))
+    if max_pairs is None:
+        n_pairs_input = n_pairs
+    logging.info("Split {} into {:,} pairs of reads".format(file_path, n_pairs))
+    if max_pairs is not None:
+        logging.info("Subsampled {:,} of {:,} pairs of reads".format(
+            n_pairs, n_pairs_input
+        ))
+
+    return r1_fp, r2_fp, n_pairs_input, n_pairs
+
+
+def sample_name_from_file(filename):
+    """Name a sample after its FASTQ file."""
+    sample_name = filename
+    for n in [".fastq", ".fq", ".gz"]:
+        sample_name = sample_name.replace(n, "")
+    return sample_name
 
-    return r1_fp, r2_fp
 
+def make_manifest(folder_with_fastqs, manifest_fp, counts_fp, max_pairs=None, seed=0):
+    """Go through a folder, split paired-end reads, and write out a manifest file.
 
-def make_manifest(folder_with_fastqs, manifest_fp):
-    """Go through a folder, split paired-end reads, and write out a manifest file."""
+    The number of pairs of reads per sample (before and after subsampling)
+    is written to `counts_fp`.
+    """
     manifest = {}
+    counts = {}
     for f in os.listdir(folder_with_fastqs):
         if f.endswith(("q.gz", "q")):
-            split_files = try_splitting_fastq_file(os.path.join(folder_with_fastqs, f))
+            split_files = try_splitting_fastq_file(
+                os.path.join(folder_with_fastqs, f),
+                max_pairs=max_pairs,
+                seed=seed
+            )
             if split_files is None:
                 continue
 
-            sample_name = f
-            for n in [".fastq", ".fq", ".gz"]:
-                sample_name = sample_name.replace(n, "")
+            sample_name = sample_name_from_file(f)
             assert sample_name not in manifest
-            manifest[sample_name] = split_files
+            manifest[sample_name] = split_files[:2]
+            counts[sample_name] = split_files[2:]
 
     with open(manifest_fp, "wt") as fo:
         for sample_name, split_files in manifest.items():
             f1, f2 = split_files
             fo.write("{}\t{}\t{}\n".format(sample_name, f1, f2))
 
+    with open(counts_fp, "wt") as fo:
+        fo.write("sample\tpairs_input\tpairs_sampled\n")
+        for sample_name, (n_input, n_output) in sorted(counts.items()):
+            fo.write("{}\t{}\t{}\n".format(sample_name, n_input, n_output))
+
 
-def run_mothur_command(command_string):
-    """Run a command in mothur."""
+def run_mothur_command(command_string, folder=None):
+    """Run a command in mothur (optionally from within `folder`)."""
     logging.info("Running mothur command:\n" + command_string)
     batch_file = "mothur.batch." + str(uuid.uuid4()).replace("-", "")
+    if folder is not None:
+        batch_file = os.path.join(folder, batch_file)
     assert os.path.exists(batch_file) is False
     with open(batch_file, "wt") as fo:
         fo.write(command_string + "\n")
     # Note: this will not catch errors -- need to check manually
-    run_cmds(["mothur", batch_file], catchExcept=True)
+    run_cmds(["mothur", os.path.abspath(batch_file)], catchExcept=True, cwd=folder)
     os.remove(batch_file)
+
+
+def count_table_is_empty(count_fp):
+    """Check whether a mothur count table has a header but no sequences."""
+    with open(count_fp, "rt") as f:
+        f.readline()
+        return len(f.readline().strip()) == 0
+
+
+def preprocess_sample(sample_name, r1_fp, r2_fp, temp_db_fasta, sample_folder, threads=1):
+    """Run the per-sample steps of the workflow for a single sample.
+
+    Each sample is run in its own folder, so that many samples can be
+    processed at the same time. Returns the paths to the aligned FASTA
+    and count table, or None if no sequences passed screening.
+    """
+    # mothur is run from within the sample folder, so use absolute paths
+    sample_folder = os.path.abspath(sample_folder)
+    os.mkdir(sample_folder)
+    manifest_fp = os.path.join(sample_folder, sample_name + ".files")
+    with open(manifest_fp, "wt") as fo:
+        fo.write("{}\t{}\t{}\n".format(
+            sample_name, os.path.abspath(r1_fp), os.path.abspath(r2_fp)
+        ))
+
+    run_mothur_command(
+        PREPROCESS_COMMANDS.format(
+            manifest_fp=manifest_fp,
+            temp_db_fasta=os.path.abspath(temp_db_fasta),
+            threads=threads
+        ),
+        folder=sample_folder
+    )
+
+    # Keep the mothur logfile alongside the outputs for this sample
+    for f in os.listdir(sample_folder):
+        if f.startswith("mothur") and f.endswith("logfile"):
+            shutil.move(
+                os.path.join(sample_folder, f),
+                os.path.join(sample_folder, sample_name + ".mothur.logfile")
+            )
+
+    # A missing output means that mothur failed, while a count table with
+    # only a header means that no sequences passed screening
+    align_fp = os.path.join(sample_folder, sample_name + ALIGN_SUFFIX)
+    count_fp = os.path.join(sample_folder, sample_name + COUNT_SUFFIX)
+    assert os.path.exists(count_fp), "No count table found for " + sample_name
+    if count_table_is_empty(count_fp):
+        logging.info("No sequences passed screening for " + sample_name)
+        return None
+    assert os.path.exists(align_fp), "No alignment found for " + sample_name
+
+    return align_fp, count_fp
+
+
+def _preprocess_sample_star(args):
+    """Unpack the arguments for preprocess_sample (used by multiprocessing)."""
+    return preprocess_sample(*args)
+
+
+def scatter_samples(manifest_fp, temp_db_fasta, temp_folder, workers, threads=16):
+    """Run the per-sample steps for every sample in a manifest in parallel.
+
+    Returns a list of (align_fp, count_fp) for the samples with outputs.
+    """
+    scatter_folder = os.path.join(temp_folder, "scatter")
+    os.mkdir(scatter_folder)
+
+    tasks = []
+    with open(manifest_fp, "rt") as f:
+        for line in f:
+            sample_name, r1_fp, r2_fp = line.rstrip("\n").split("\t")
+            tasks.append((
+                sample_name,
+                r1_fp,
+                r2_fp,
+                temp_db_fasta,
+                os.path.join(scatter_folder, sample_name),
+                max(1, threads // workers)
+            ))
+
+    logging.info("Processing {:,} samples with {:,} workers".format(
+        len(tasks), workers
+    ))
+    pool = multiprocessing.Pool(workers)
+    try:
+        outputs = pool.map(_preprocess_sample_star, tasks)
+    finally:
+        pool.close()
+        pool.join()
+
+    return [o for o in outputs if o is not None]
+
+
+def merge_count_tables(count_fps, merged_fp):
+    """Merge mothur count tables, filling in zeros for missing groups."""
+    # Get the full list of groups from the headers
+    groups = []
+    for fp in count_fps:
+        with open(fp, "rt") as f:
+            header = f.readline().rstrip("\n").split("\t")
+        msg = "Unexpected count table format: " + fp
+        assert header[:2] == ["Representative_Sequence", "total"], msg
+        for group in header[2:]:
+            if group not in groups:
+                groups.append(group)
+    group_ix = dict([(group, ix) for ix, group in enumerate(groups)])
+
+    with open(merged_fp, "wt") as fo:
+        fo.write("\t".join(["Representative_Sequence", "total"] + groups) + "\n")
+        for fp in count_fps:
+            with open(fp, "rt") as f:
+                header = f.readline().rstrip("\n").split("\t")
+                for line in f:
+                    fields = line.rstrip("\n").split("\t")
+                    counts = ["0"] * len(groups)
+                    for group, n in zip(header[2:], fields[2:]):
+                        counts[group_ix[group]] = n
+                    fo.write("\t".join(fields[:2] + counts) + "\n")
+
+    logging.info("Merged {:,} count tables into {}".format(
+        len(count_fps), merged_fp
+    ))
+
+
+def merge_sample_outputs(sample_outputs, temp_folder, output_prefix):
+    """Merge the per-sample alignments and count tables, return the merged paths.
+
+    The merged files are named as if the per-sample steps were run on all
+    samples at once, and are used as the input to CLASSIFY_COMMANDS.
+    """
+    assert len(sample_outputs) > 0, "No samples had any sequences pass screening"
+    sample_outputs = sorted(sample_outputs)
+
+    align_fp = os.path.join(temp_folder, output_prefix + ALIGN_SUFFIX)
+    with open(align_fp, "wt") as fo:
+        for sample_align_fp, sample_count_fp in sample_outputs:
+            with open(sample_align_fp, "rt") as f:
+                shutil.copyfileobj(f, fo)
+
+    count_fp = os.path.join(temp_folder, output_prefix + COUNT_SUFFIX)
+    merge_count_tables([fp for _, fp in sample_outputs], count_fp)
+
+    return align_fp, count_fp
+
+
+def gather_samples(folder, temp_folder, output_prefix, expected_samples=None):
+    """Merge the outputs of a set of scatter tasks found in `folder`.
+
+    If `expected_samples` is given, every one of those samples must have
+    been processed by a scatter task.
+    Returns the paths to the merged aligned FASTA and count table.
+    """
+    sample_outputs = []
+    found_samples = set()
+    for f in os.listdir(folder):
+        if f.endswith(ALIGN_SUFFIX):
+            sample_name = f[:-len(ALIGN_SUFFIX)]
+            count_fp = os.path.join(folder, sample_name + COUNT_SUFFIX)
+            assert os.path.exists(count_fp), "No count table found for " + sample_name
+            sample_outputs.append((os.path.join(folder, f), count_fp))
+            found_samples.add(sample_name)
+    logging.info("Found outputs for {:,} samples in {}".format(
+        len(sample_outputs), folder
+    ))
+
+    # Every sample processed by a scatter task must have outputs, unless no
+    # sequences passed screening (in which case the count table is empty)
+    counts_fps = sorted([
+        f for f in os.listdir(folder) if f.endswith(".subsample.txt")
+    ])
+    if expected_samples is not None:
+        # Each scatter task uploads <sample>.subsample.txt before it starts
+        # processing, so a missing file means the task never ran
+        processed = set([f[:-len(".subsample.txt")] for f in counts_fps])
+        missing = sorted(set(expected_samples) - processed)
+        msg = "No scatter task outputs found for {:,} samples: {}".format(
+            len(missing), ", ".join(missing)
+        )
+        assert len(missing) == 0, msg
+    for f in counts_fps:
+        with open(os.path.join(folder, f), "rt") as fi:
+            fi.readline()
+            for line in fi:
+                sample_name = line.rstrip("\n").split("\t")[0]
+                if sample_name in found_samples:
+                    continue
+                count_fp = os.path.join(folder, sample_name + COUNT_SUFFIX)
+                msg = "No outputs found for {}, check the scatter task logs"
+                assert os.path.exists(count_fp), msg.format(sample_name)
+                msg = "No alignment found for " + sample_name
+                assert count_table_is_empty(count_fp), msg
+
+    # Combine the number of reads per sample from each task
+    if len(counts_fps) > 0:
+        with open(os.path.join(temp_folder, output_prefix + ".subsample.txt"), "wt") as fo:
+            fo.write("sample\tpairs_input\tpairs_sampled\n")
+            for f in counts_fps:
+                with open(os.path.join(folder, f), "rt") as fi:
+                    fi.readline()
+                    shutil.copyfileobj(fi, fo)
+
+    return merge_sample_outputs(sample_outputs, temp_folder, output_prefix)
+
+
+def list_scatter_inputs(input_folder):
+    """List the FASTQ files processed by the tasks of a scatter array job.
+
+    Files are sorted by name, so that every task in an array job agrees on
+    which file belongs to which index.
+    """
+    if input_folder.startswith("s3://"):
+        paths = list_s3_folder(input_folder)
+    else:
+        paths = [os.path.join(input_folder, f) for f in os.listdir(input_folder)]
+    return sorted([p for p in paths if p.endswith(("q.gz", "q"))])
+
+
+def fetch_scatter_task_input(input_folder, temp_folder_input, task_index):
+    """Fetch the single FASTQ file to be processed by a scatter task."""
+    paths = list_scatter_inputs(input_folder)
+    msg = "Task index {} is out of range ({:,} files)".format(task_index, len(paths))
+    assert 0 <= task_index < len(paths), msg
+
+    path = paths[task_index]
+    logging.info("Processing file {} of {}: {}".format(
+        task_index + 1, len(paths), path
+    ))
+    os.mkdir(temp_folder_input)
+    if path.startswith("s3://"):
+        run_cmds(["aws", "s3", "cp", path, temp_folder_input + "/"])
+    else:
+        os.symlink(
+            os.path.abspath(path),
+            os.path.join(temp_folder_input, path.split("/")[-1])
+        )
+
+
+def find_output(folder, endings):
+    """Return the single file in `folder` with one of the given endings."""
+    matches = [f for f in os.listdir(folder) if f.endswith(endings)]
+    msg = "Expected one output ending with {}, found {}".format(endings, matches)
+    assert len(matches) == 1, msg
+    return os.path.join(folder, matches[0])
+
+
+def cluster_within_memory(temp_folder, output_prefix, output_folder, cluster_memory_gb,
+                          threads=16, seed=0):
+    """Cluster the preclustered sequences within a memory budget, and finish the workflow.
+
+    The memory used by each group of sequences is written to
+    `<prefix>.cluster_memory.txt`, which is uploaded to `output_folder`
+    straight away if any group could not be clustered.
+    """
+    fasta_fp = find_output(temp_folder, (".precluster.align", ".precluster.fasta"))
+    count_fp = find_output(temp_folder, ".precluster.count_table")
+    taxonomy_fp = find_output(temp_folder, ".wang.taxonomy")
+
+    list_fp, dist_fp, stats = run_cluster_stage(
+        fasta_fp,
+        count_fp,
+        taxonomy_fp,
+        temp_folder,
+        int(cluster_memory_gb * 1024 ** 3),
+        threads=threads,
+        seed=seed
+    )
+
+    report_fp = os.path.join(temp_folder, output_prefix + ".cluster_memory.txt")
+    with open(report_fp, "wt") as fo:
+        fo.write("group\ttaxlevel\tcutoff\tn_seqs\tpeak_memory_mb\telapsed_seconds\tfailures\n")
+        for group_stats in stats:
+            fo.write("{}\t{}\t{}\t{}\t{}\t{:.1f}\t{}\n".format(
+                group_stats["group"],
+                group_stats["taxlevel"],
+                group_stats["cutoff"],
+                group_stats["n_seqs"],
+                group_stats["peak_memory"] // 1024 ** 2,
+                group_stats["elapsed"],
+                ",".join(group_stats["failures"])
+            ))
+
+    if list_fp is None:
+        # The rest of the outputs are not uploaded, so upload the report now
+        for group_stats in stats:
+            if len(group_stats["failures"]) > 0:
+                logging.info("Failed attempts for {}: {}".format(
+                    group_stats["group"], ", ".join(group_stats["failures"])
+                ))
+        upload_file(report_fp, output_folder)
+    msg = "Clustering failed for some groups, see {}.cluster_memory.txt".format(output_prefix)
+    assert list_fp is not None, msg
+
+    run_mothur_command(
+        BOUNDED_CLUSTER_COMMANDS.format(
+            list_fp=list_fp,
+            count_fp=count_fp,
+            taxonomy_fp=taxonomy_fp
+        )
+    )
+
+
+def upload_file(fp, output_folder):
+    """Copy a single file to the output folder."""
+    if output_folder.startswith("s3://"):
+        run_cmds(["aws", "s3", "cp", fp, output_folder])
+    else:
+        if not os.path.exists(output_folder):
+            os.mkdir(output_folder)
+        run_cmds(["cp", fp, output_folder])
     
 
 def run_mothur(
@@ -99,9 +488,33 @@ def run_mothur(
     output_folder, 
     output_prefix=datetime.datetime.today().strftime('%Y_%m_%d_%H_%M'),
     threads=16,
-    temp_folder="/scratch"
+    temp_folder="/scratch",
+    max_pairs=None,
+    seed=0,
+    scatter_workers=1,
+    scatter_task=False,
+    task_index=None,
+    gather=False,
+    scatter_input=None,
+    cluster_memory_gb=None,
+    ref_region_cache=None,
+    region=None
 ):
-    """Run mothur end-to-end on a set of FASTQ files."""
+    """Run mothur end-to-end on a set of FASTQ files.
+
+    The per-sample steps of the workflow can be run in parallel, either with
+    `scatter_workers` local processes, or as an array of Batch jobs
+    (`scatter_task`) whose outputs are merged and finished with `gather`
+    (checking that every sample in `scatter_input` was processed).
+    If `cluster_memory_gb` is set, the clustering parameters are picked to
+    fit within that amount of memory, instead of using cluster.split.
+    If `ref_region_cache` is set, the reference is trimmed to the region of
+    the alignment covered by the reads (or `region`, if given).
+    """
+    assert not (scatter_task and gather), "Cannot both scatter and gather"
+    if ref_region_cache is not None and (scatter_task or gather):
+        # Every task must use the same region, so that the alignments can be merged
+        assert region is not None, "Region must be specified when scattering"
 
     # Set up logging
     log_fp = '{}.log.txt'.format(output_prefix)
@@ -146,6 +559,41 @@ def run_mothur(
     temp_folder_input = os.path.join(temp_folder, "input")
     logging.info("Using temp folder for all input data: " + temp_folder_input)
 
+    if scatter_task:
+        # Each task in the array processes a single file from the input folder
+        if task_index is None:
+            task_index = int(os.environ["AWS_BATCH_JOB_ARRAY_INDEX"])
+        if ref_region_cache is not None:
+            temp_db_fasta, temp_db_tax, region = get_region_reference(
+                [],
+                temp_db_fasta,
+                temp_db_tax,
+                ref_region_cache,
+                temp_folder,
+                region=region,
+                threads=threads
+            )
+        run_scatter_task(
+            input_folder,
+            output_folder,
+            temp_folder,
+            temp_folder_input,
+            temp_db_fasta,
+            task_index,
+            threads=threads,
+            max_pairs=max_pairs,
+            seed=seed
+        )
+
+        # Delete everything in the temporary folder
+        logging.info("Deleting temporary folder {}".format(temp_folder))
+        shutil.rmtree(temp_folder)
+
+        # Stop logging
+        logging.info("Done")
+        logging.shutdown()
+        return
+
     # Put the input data into the `temp_folder_input`
     if input_folder.startswith("s3://"):
         # Get data from S3
@@ -162,34 +610,108 @@ def run_mothur(
         temp_folder_input, len(os.listdir(temp_folder_input))
     ))
 
-    # Make a manifest file
-    manifest_fp = os.path.join(temp_folder, output_prefix + ".files")
-    assert os.path.exists(manifest_fp) is False
-    make_manifest(temp_folder_input, manifest_fp)
-    assert os.path.exists(manifest_fp)
+    # Merged outputs of the per-sample steps, when run separately
+    align_fp, count_fp = None, None
+
+    if gather:
+        # The input folder contains the outputs of a set of scatter tasks
+        expected_samples = None
+        if scatter_input is not None:
+            expected_samples = [
+                sample_name_from_file(path.split("/")[-1])
+                for path in list_scatter_inputs(scatter_input)
+            ]
+        align_fp, count_fp = gather_samples(
+            temp_folder_input, temp_folder, output_prefix,
+            expected_samples=expected_samples
+        )
+    else:
+        # Make a manifest file
+        manifest_fp = os.path.join(temp_folder, output_prefix + ".files")
+        assert os.path.exists(manifest_fp) is False
+        # Also record the number of reads per sample, before and after subsampling
+        counts_fp = os.path.join(temp_folder, output_prefix + ".subsample.txt")
+        make_manifest(
+            temp_folder_input,
+            manifest_fp,
+            counts_fp,
+            max_pairs=max_pairs,
+            seed=seed
+        )
+        assert os.path.exists(manifest_fp)
+
+    # Trim the reference to the region covered by the reads
+    if ref_region_cache is not None:
+        read_fps = []
+        if not gather:
+            with open(manifest_fp, "rt") as f:
+                for line in f:
+                    read_fps.extend(line.rstrip("\n").split("\t")[1:])
+        temp_db_fasta, temp_db_tax, region = get_region_reference(
+            read_fps,
+            temp_db_fasta,
+            temp_db_tax,
+            ref_region_cache,
+            temp_folder,
+            region=region,
+            threads=threads
+        )
 
-    # Run the whole mothur workflow
-    # Note: this will not catch errors -- need to check manually by the existance of output files
-    run_mothur_command(
-        """# mothur workflow
-make.contigs(file={manifest_fp}, processors={threads})
-screen.seqs(fasta=current, group=current, maxambig=0, maxlength=275)
-unique.seqs()
-count.seqs(name=current, group=current)
-align.seqs(fasta=current, reference={temp_db_fasta})
-unique.seqs(fasta=current, count=current)
-pre.cluster(fasta=current, count=current, diffs=2)
-classify.seqs(fasta=current, count=current, reference={temp_db_fasta}, taxonomy={temp_db_tax}, cutoff=80)
-cluster.split(fasta=current, count=current, taxonomy=current, splitmethod=classify, taxlevel=4, cutoff=0.15)
-classify.otu(list=current, count=current, taxonomy=current, label=0.03)
-phylotype(taxonomy=current)
-make.shared(list=current, count=current, label=1)""".format(
+    if not gather and scatter_workers > 1:
+        # Run the per-sample steps in parallel, and then merge the outputs
+        sample_outputs = scatter_samples(
+            manifest_fp,
+            temp_db_fasta,
+            temp_folder,
+            scatter_workers,
+            threads=threads
+        )
+        for align_fp, _ in sample_outputs:
+            sample_folder = os.path.dirname(align_fp)
+            sample_name = os.path.basename(sample_folder)
+            log_fp = os.path.join(sample_folder, sample_name + ".mothur.logfile")
+            if os.path.exists(log_fp):
+                shutil.move(log_fp, os.path.join(
+                    temp_folder, output_prefix + "." + sample_name + ".mothur.logfile"
+                ))
+        align_fp, count_fp = merge_sample_outputs(
+            sample_outputs, temp_folder, output_prefix
+        )
+
+    if align_fp is not None:
+        # Run the rest of the workflow on the merged outputs
+        workflow = CLASSIFY_COMMANDS.format(
+            fasta=align_fp,
+            count=count_fp,
+            temp_db_fasta=temp_db_fasta,
+            temp_db_tax=temp_db_tax
+        )
+    else:
+        workflow = PREPROCESS_COMMANDS.format(
             temp_db_fasta=temp_db_fasta,
-            temp_db_tax=temp_db_tax,
             manifest_fp=manifest_fp,
             threads=threads
+        ) + "\n" + CLASSIFY_COMMANDS.format(
+            fasta="current",
+            count="current",
+            temp_db_fasta=temp_db_fasta,
+            temp_db_tax=temp_db_tax
+        )
+
+    # Run the whole mothur workflow
+    # Note: this will not catch errors -- need to check manually by the existance of output files
+    if cluster_memory_gb is None:
+        run_mothur_command("# mothur workflow\n" + workflow + "\n" + CLUSTER_COMMANDS)
+    else:
+        run_mothur_command("# mothur workflow\n" + workflow)
+        cluster_within_memory(
+            temp_folder,
+            output_prefix,
+            output_folder,
+            cluster_memory_gb,
+            threads=threads,
+            seed=seed
         )
-    )
 
     for ending in ["precluster.count_table", "precluster.gg.wang.tx.list", "unique.precluster.dist"]:
         assert any([f.endswith(ending) for f in os.listdir(temp_folder)]), "No outputs ending with " + ending
@@ -219,12 +741,7 @@ make.shared(list=current, count=current, label=1)""".format(
             if os.stat(fp).st_size == 0:
                 continue
 
-            if output_folder.startswith("s3://"):
-                run_cmds(["aws", "s3", "cp", fp, output_folder])
-            else:
-                if not os.path.exists(output_folder):
-                    os.mkdir(output_folder)
-                run_cmds(["cp", fp, output_folder])
+            upload_file(fp, output_folder)
         else:            
             logging.info("Skipping: " + f)
 
@@ -238,6 +755,60 @@ make.shared(list=current, count=current, label=1)""".format(
     logging.shutdown()
 
 
+def run_scatter_task(
+    input_folder,
+    output_folder,
+    temp_folder,
+    temp_folder_input,
+    temp_db_fasta,
+    task_index,
+    threads=16,
+    max_pairs=None,
+    seed=0
+):
+    """Run the per-sample steps for a single file, and upload the outputs."""
+    fetch_scatter_task_input(input_folder, temp_folder_input, task_index)
+
+    # Split the reads and record the number of reads for this sample
+    manifest_fp = os.path.join(temp_folder, "task.files")
+    counts_fp = os.path.join(temp_folder, "task.subsample.txt")
+    make_manifest(
+        temp_folder_input,
+        manifest_fp,
+        counts_fp,
+        max_pairs=max_pairs,
+        seed=seed
+    )
+    with open(manifest_fp, "rt") as f:
+        lines = f.readlines()
+    assert len(lines) == 1, "Could not find a FASTQ file for task " + str(task_index)
+    sample_name, r1_fp, r2_fp = lines[0].rstrip("\n").split("\t")
+
+    # Upload the counts before processing the sample, so that the gather
+    # step can tell that this task started even if it fails
+    new_counts_fp = os.path.join(temp_folder, sample_name + ".subsample.txt")
+    shutil.move(counts_fp, new_counts_fp)
+    upload_file(new_counts_fp, output_folder)
+
+    sample_folder = os.path.join(temp_folder, sample_name)
+    sample_outputs = preprocess_sample(
+        sample_name, r1_fp, r2_fp, temp_db_fasta, sample_folder, threads=threads
+    )
+
+    # Upload the logs and outputs for this sample
+    log_fp = os.path.join(sample_folder, sample_name + ".mothur.logfile")
+    if os.path.exists(log_fp):
+        upload_file(log_fp, output_folder)
+    if sample_outputs is not None:
+        for fp in sample_outputs:
+            upload_file(fp, output_folder)
+    else:
+        # Upload the empty count table, to show that the sample was processed
+        upload_file(
+            os.path.join(sample_folder, sample_name + COUNT_SUFFIX), output_folder
+        )
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="""
     Run mothur on a set of FASTQ files.
@@ -260,6 +831,59 @@ if __name__ == "__main__":
                         type=str,
                         default='/scratch',
                         help="Folder used for temporary files.")
+    parser.add_argument("--max-pairs",
+                        type=int,
+                        default=None,
+                        help="""Randomly subsample each sample to at most this
+                                many pairs of reads.""")
+    parser.add_argument("--seed",
+                        type=int,
+                        default=0,
+                        help="Random seed used for subsampling.")
+    parser.add_argument("--scatter-workers",
+                        type=int,
+                        default=1,
+                        help="""Number of samples to preprocess in parallel
+                                (contig assembly through alignment).""")
+    parser.add_argument("--scatter-task",
+                        action="store_true",
+                        help="""Only preprocess a single file from the input
+                                folder, and write the outputs to the output
+                                folder (for use in a Batch array job).""")
+    parser.add_argument("--task-index",
+                        type=int,
+                        default=None,
+                        help="""Index of the file to process with --scatter-task
+                                (default: $AWS_BATCH_JOB_ARRAY_INDEX).""")
+    parser.add_argument("--gather",
+                        action="store_true",
+                        help="""Merge the outputs of a set of --scatter-task
+                                jobs in the input folder and run the rest of
+                                the workflow.""")
+    parser.add_argument("--scatter-input",
+                        type=str,
+                        default=None,
+                        help="""Input folder of the --scatter-task jobs. Used
+                                with --gather to check that every sample in it
+                                was processed.""")
+    parser.add_argument("--cluster-memory-gb",
+                        type=float,
+                        default=None,
+                        help="""Memory available for clustering (GB). If set,
+                                the split level and cutoff are picked to fit,
+                                and each group is clustered in parallel.""")
+    parser.add_argument("--ref-region-cache",
+                        type=str,
+                        default=None,
+                        help="""Folder used to cache copies of the reference
+                                trimmed to the region covered by the reads.
+                                (Supported: s3://, or local path).""")
+    parser.add_argument("--region",
+                        type=parse_region,
+                        default=None,
+                        help="""Region of the reference alignment to use, as
+                                START:END (default: detect from the reads).
+                                Required with --scatter-task and --gather.""")
 
     args = parser.parse_args()
 
@@ -0,0 +1,152 @@
+#!/usr/bin/python
+"""Wrapper script to translate classify.seqs results into another taxonomy."""
+
+import os
+import gzip
+import json
+import uuid
+import shutil
+import logging
+import argparse
+from s3_helpers import get_file
+from exec_helpers import run_cmds
+from taxonomy_store import TaxonomyStore
+from taxonomy_store import TaxonomyTranslator
+from taxonomy_store import BUNDLED_DB_FOLDER
+from taxonomy_store import load_bundled_taxonomies
+from taxonomy_store import translate_results
+from taxonomy_store import translate_taxonomy_file
+
+
+def get_taxonomy(name_or_path, bundled):
+    """Get a taxonomy by the name of a bundled taxonomy, or a path to a .tax file."""
+    if name_or_path in bundled:
+        return bundled[name_or_path]
+    assert os.path.exists(name_or_path), "Taxonomy not found: " + name_or_path
+    return TaxonomyStore.load(name_or_path)
+
+
+def translate_taxonomy(input_str,
+                       output_str,
+                       source,
+                       target,
+                       db_folder=BUNDLED_DB_FOLDER,
+                       min_agreement=80,
+                       temp_folder='/scratch'):
+    """Translate a .taxonomy file or the JSON output of run_classify_seqs.py."""
+    bundled = {}
+    if os.path.exists(db_folder):
+        bundled = load_bundled_taxonomies(db_folder)
+    translator = TaxonomyTranslator(
+        get_taxonomy(source, bundled),
+        get_taxonomy(target, bundled),
+        min_agreement=min_agreement
+    )
+
+    input_fp = get_file(input_str, temp_folder)
+    output_fp = os.path.join(temp_folder, output_str.split('/')[-1])
+    assert output_fp != input_fp, "Output must not overwrite the input"
+
+    if input_fp.endswith(".json.gz"):
+        results = json.load(gzip.open(input_fp))
+        results = translate_results(results, translator)
+        results["metadata"]["source_taxonomy"] = source
+        results["metadata"]["target_taxonomy"] = target
+        with gzip.open(output_fp, "wb") as fo:
+            fo.write(json.dumps(results).encode("utf-8"))
+        output_fps = [output_fp]
+    else:
+        assert output_fp.endswith(".taxonomy"), "Output must end with .taxonomy"
+        summary_fp = output_fp[:-len(".taxonomy")] + ".tax.summary"
+        translate_taxonomy_file(input_fp, output_fp, summary_fp, translator)
+        output_fps = [output_fp, summary_fp]
+    logging.info("Translated {} from {} to {}".format(input_str, source, target))
+
+    # Copy the outputs alongside `output_str`
+    output_folder = output_str[:-len(output_str.split('/')[-1])]
+    for fp in output_fps:
+        if output_folder.startswith('s3://'):
+            run_cmds(['aws', 's3', 'cp', '--quiet',
+                      '--sse', 'AES256',
+                      fp, output_folder])
+        else:
+            output_folder = output_folder or '.'
+            if not os.path.exists(output_folder):
+                os.makedirs(output_folder)
+            run_cmds(['mv', fp, output_folder])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="""
+    Translate the results of classify.seqs into another taxonomy.
+    """)
+
+    parser.add_argument("--input",
+                        type=str,
+                        required=True,
+                        help="""Output from classify.seqs (.taxonomy) or
+                                run_classify_seqs.py (.json.gz).
+                                (Supported: s3://, or local path).""")
+    parser.add_argument("--output",
+                        type=str,
+                        required=True,
+                        help="""Path for the translated results. For a
+                                .taxonomy, a .tax.summary is also written.
+                                (Supported: s3://, or local path).""")
+    parser.add_argument("--source",
+                        type=str,
+                        required=True,
+                        help="""Taxonomy used for the input, either a bundled
+                                taxonomy (e.g. gg) or a path to a .tax file.""")
+    parser.add_argument("--target",
+                        type=str,
+                        required=True,
+                        help="""Taxonomy to translate into, either a bundled
+                                taxonomy (e.g. rdp) or a path to a .tax file.""")
+    parser.add_argument("--db-folder",
+                        type=str,
+                        default=BUNDLED_DB_FOLDER,
+                        help="Folder containing the bundled taxonomies.")
+    parser.add_argument("--min-agreement",
+                        type=int,
+                        default=80,
+                        help="""Minimum percent of reference sequences which
+                                must agree on each level of the lineage.""")
+    parser.add_argument("--temp-folder",
+                        type=str,
+                        default='/scratch',
+                        help="Folder used for temporary files.")
+
+    args = parser.parse_args()
+
+    # Make a temporary folder to place data into
+    temp_folder = os.path.join(args.temp_folder, str(uuid.uuid4())[:8])
+    assert os.path.exists(temp_folder) is False
+    os.mkdir(temp_folder)
+
+    # Set up logging
+    fmt = '%(asctime)s %(levelname)-8s [mothur.translate] %(message)s'
+    logFormatter = logging.Formatter(fmt)
+    rootLogger = logging.getLogger()
+    rootLogger.setLevel(logging.INFO)
+    consoleHandler = logging.StreamHandler()
+    consoleHandler.setFormatter(logFormatter)
+    rootLogger.addHandler(consoleHandler)
+
+    try:
+        translate_taxonomy(
+            args.input,
+            args.output,
+            args.source,
+            args.target,
+            db_folder=args.db_folder,
+            min_agreement=args.min_agreement,
+            temp_folder=temp_folder
+        )
+    finally:
+        # Delete everything in the temporary folder
+        logging.info("Deleting temporary folder {}".format(temp_folder))
+        shutil.rmtree(temp_folder)
+
+    logging.info("Done")
+    logging.shutdown()
@@ -0,0 +1,80 @@
+#!/usr/bin/python
+"""Test merging list files, and retrying failed groups, in cluster_helpers."""
+
+import os
+import sys
+import stat
+import shutil
+import tempfile
+from cluster_helpers import cluster_group
+from cluster_helpers import merge_list_files
+from cluster_helpers import read_list_file
+
+folder = tempfile.mkdtemp()
+
+# Merge a clustered group with a group of singletons
+opti_fp = os.path.join(folder, "opti.list")
+with open(opti_fp, "wt") as fo:
+    fo.write("label\tnumOtus\tOtu1\n")
+    fo.write("0.15\t1\ta,b\n")
+unique_fp = os.path.join(folder, "unique.list")
+with open(unique_fp, "wt") as fo:
+    fo.write("unique\t2\tc\td\n")
+merged_fp = os.path.join(folder, "merged.list")
+merge_list_files([opti_fp, unique_fp], merged_fp)
+merged = read_list_file(merged_fp)
+# Below the smallest label of a group, each sequence is its own OTU
+assert sorted(merged["unique"]) == ["a", "b", "c", "d"], merged
+assert sorted(merged["0.15"]) == ["a,b", "c", "d"], merged
+
+# Stand in for mothur, failing for some groups and cutoffs
+fake_mothur = """#!{}
+import os, re, sys
+cmd = open(sys.argv[1]).read()
+cutoff = float(re.search("cutoff=([0-9.]+)", cmd).group(1))
+mode = os.path.basename(os.getcwd())
+if mode == "fail" or (mode == "retry" and cutoff > 0.1):
+    sys.exit(1)
+if mode == "empty":
+    open("group.dist", "wt").close()
+    sys.exit(0)
+open("group.dist", "wt").write("a\\tb\\t0.01\\n")
+open("group.opti_mcc.list", "wt").write("label\\tnumOtus\\tOtu1\\n0.03\\t1\\ta,b\\n")
+""".format(sys.executable)
+bin_folder = os.path.join(folder, "bin")
+os.mkdir(bin_folder)
+with open(os.path.join(bin_folder, "mothur"), "wt") as fo:
+    fo.write(fake_mothur)
+os.chmod(os.path.join(bin_folder, "mothur"), stat.S_IRWXU)
+os.environ["PATH"] = bin_folder + ":" + os.environ["PATH"]
+
+results = {}
+for mode in ["ok", "retry", "empty", "fail"]:
+    group_folder = os.path.join(folder, mode)
+    os.mkdir(group_folder)
+    with open(os.path.join(group_folder, "group.fasta"), "wt") as fo:
+        fo.write(">a\nACGT\n>b\nACGA\n")
+    with open(os.path.join(group_folder, "group.count_table"), "wt") as fo:
+        fo.write("Representative_Sequence\ttotal\na\t1\nb\t1\n")
+    results[mode] = cluster_group(group_folder, 0.15, 1024 ** 3)
+
+list_fp, dist_fp, stats = results["ok"]
+assert list_fp.endswith("group.opti_mcc.list")
+assert stats["cutoff"] == 0.15 and stats["failures"] == []
+
+# A failed group is retried with the next smaller cutoff
+list_fp, dist_fp, stats = results["retry"]
+assert list_fp.endswith("group.opti_mcc.list")
+assert stats["cutoff"] == 0.1 and stats["failures"] == ["0.15:1"]
+
+# Singletons are only written if mothur found no distances below the cutoff
+list_fp, dist_fp, stats = results["empty"]
+assert list_fp.endswith("group.unique.list")
+assert read_list_file(list_fp) == {"unique": ["a", "b"]}
+
+# A group which fails at every cutoff has no list file
+list_fp, dist_fp, stats = results["fail"]
+assert list_fp is None
+assert stats["failures"] == ["0.15:1", "0.1:1", "0.05:1", "0.03:1"]
+
+shutil.rmtree(folder)
@@ -0,0 +1,48 @@
+#!/usr/bin/python
+"""Test subsampling pairs of reads with the --max-pairs option of run_mothur_from_fastq.py."""
+
+import os
+import sys
+import shutil
+import tempfile
+from Bio.SeqIO.QualityIO import FastqGeneralIterator
+
+sys.path.insert(0, "/bin")
+from run_mothur_from_fastq import make_manifest  # noqa
+
+fastq_fp = sys.argv[1]
+max_pairs = int(sys.argv[2])
+assert os.path.exists(fastq_fp)
+
+# Make an interleaved FASTQ, with a pair of mates for each read
+folder = tempfile.mkdtemp()
+n_pairs = 0
+with open(fastq_fp, "rt") as f, open(os.path.join(folder, "sample.fastq"), "wt") as fo:
+    for header, seq, qual in FastqGeneralIterator(f):
+        for mate in ["1", "2"]:
+            fo.write("@{}/{}\n{}\n+\n{}\n".format(header, mate, seq, qual))
+        n_pairs += 1
+assert n_pairs > max_pairs
+
+manifest_fp = os.path.join(folder, "sample.files")
+counts_fp = os.path.join(folder, "sample.subsample.txt")
+make_manifest(folder, manifest_fp, counts_fp, max_pairs=max_pairs, seed=1)
+
+# The R1 and R2 files hold the same pairs, in the same order
+with open(manifest_fp, "rt") as f:
+    sample_name, r1_fp, r2_fp = f.readline().rstrip("\n").split("\t")
+with open(r1_fp, "rt") as f:
+    r1_headers = [header for header, seq, qual in FastqGeneralIterator(f)]
+with open(r2_fp, "rt") as f:
+    r2_headers = [header for header, seq, qual in FastqGeneralIterator(f)]
+assert len(r1_headers) == max_pairs
+assert all([h.endswith("/1") for h in r1_headers])
+assert all([h.endswith("/2") for h in r2_headers])
+assert [h[:-2] for h in r1_headers] == [h[:-2] for h in r2_headers]
+
+# The number of pairs before and after subsampling is recorded
+with open(counts_fp, "rt") as f:
+    assert f.readline() == "sample\tpairs_input\tpairs_sampled\n"
+    assert f.readline() == "sample\t{}\t{}\n".format(n_pairs, max_pairs)
+
+shutil.rmtree(folder)
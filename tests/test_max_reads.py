@@ -0,0 +1,26 @@
+#!/usr/bin/python
+"""Test subsampling with the --max-reads option of run_classify_seqs.py."""
+
+import os
+import sys
+import gzip
+import json
+
+fp1, fp2 = sys.argv[1], sys.argv[2]
+max_reads = int(sys.argv[3])
+assert os.path.exists(fp1)
+assert os.path.exists(fp2)
+result1 = json.load(gzip.open(fp1))
+result2 = json.load(gzip.open(fp2))
+
+# The input was subsampled to the number of reads requested
+metadata = result1["metadata"]
+assert metadata["max_reads"] == max_reads
+assert metadata["n_reads_sampled"] == max_reads
+assert metadata["n_reads_input"] > max_reads
+assert len(result1["read_level"]) == max_reads
+
+# The same seed gives the same sample of reads
+headers1 = [r["header"] for r in result1["read_level"]]
+headers2 = [r["header"] for r in result2["read_level"]]
+assert sorted(headers1) == sorted(headers2)
@@ -40,3 +40,50 @@
   
   python /usr/local/tests/test_run_classify_seqs.py /usr/local/tests/test_query2.json.gz
 }
+
+@test "run_classify_seqs.py - max reads" {
+  cp /usr/local/tests/test_db.fasta /usr/local/tests/test_max_reads.fasta
+  run_classify_seqs.py --ref-fasta /usr/local/tests/test_db.fasta --ref-taxonomy /usr/local/tests/test_db.tax --output-folder /usr/local/tests/ --input /usr/local/tests/test_max_reads.fasta --sample-name test_max_reads_1 --max-reads 5 --seed 1
+  run_classify_seqs.py --ref-fasta /usr/local/tests/test_db.fasta --ref-taxonomy /usr/local/tests/test_db.tax --output-folder /usr/local/tests/ --input /usr/local/tests/test_max_reads.fasta --sample-name test_max_reads_2 --max-reads 5 --seed 1
+
+  python /usr/local/tests/test_max_reads.py /usr/local/tests/test_max_reads_1.json.gz /usr/local/tests/test_max_reads_2.json.gz 5
+}
+
+@test "run_classify_seqs.py - max reads (FASTQ)" {
+  run_classify_seqs.py --ref-fasta /usr/local/tests/test_db.fasta --ref-taxonomy /usr/local/tests/test_db.tax --output-folder /usr/local/tests/ --input /usr/local/tests/test_max_reads.fastq --sample-name test_max_reads_fastq_1 --max-reads 5 --seed 1
+  run_classify_seqs.py --ref-fasta /usr/local/tests/test_db.fasta --ref-taxonomy /usr/local/tests/test_db.tax --output-folder /usr/local/tests/ --input /usr/local/tests/test_max_reads.fastq --sample-name test_max_reads_fastq_2 --max-reads 5 --seed 1
+
+  python /usr/local/tests/test_max_reads.py /usr/local/tests/test_max_reads_fastq_1.json.gz /usr/local/tests/test_max_reads_fastq_2.json.gz 5
+}
+
+@test "run_mothur_from_fastq.py - max pairs" {
+  python /usr/local/tests/test_max_pairs.py /usr/local/tests/test_max_reads.fastq 4
+}
+
+@test "cluster_helpers.py" {
+  python /usr/local/tests/test_cluster_helpers.py
+}
+
+@test "run_translate_taxonomy.py" {
+  printf "read1\tBacteria(100);Proteobacteria(100);Gammaproteobacteria(100);Betaproteobacteria(100);Rhodocyclales(100);Azoarcus(100);BANW526(100);\n" > /usr/local/tests/test_translate.gg.wang.taxonomy
+  run_translate_taxonomy.py --input /usr/local/tests/test_translate.gg.wang.taxonomy --output /usr/local/tests/test_translate.rdp.wang.taxonomy --source gg --target rdp
+
+  result="$(cut -f 2 /usr/local/tests/test_translate.rdp.wang.taxonomy)"
+  [ "$result" == "Bacteria(100);Proteobacteria(100);Betaproteobacteria(100);Rhodocyclales(100);Rhodocyclaceae(100);Azoarcus(100);" ]
+}
+
+@test "run_classify_seqs_worker.py" {
+  run_classify_seqs_worker.py enqueue --queue /usr/local/tests/test_queue.sqlite --ref-fasta /usr/local/tests/test_db.fasta --ref-taxonomy /usr/local/tests/test_db.tax --output-folder /usr/local/tests/ --input /usr/local/tests/test_query2.fastq --sample-name test_query2_worker
+  run_classify_seqs_worker.py work --queue /usr/local/tests/test_queue.sqlite --idle-timeout 0
+
+  python /usr/local/tests/test_run_classify_seqs.py /usr/local/tests/test_query2_worker.json.gz
+}
+
+@test "run_classify_seqs_worker.py - relative paths" {
+  cd /usr/local/tests
+  run_classify_seqs_worker.py enqueue --queue test_queue_relative.sqlite --ref-fasta test_db.fasta --ref-taxonomy test_db.tax --output-folder ../tests --input test_query2.fastq --sample-name test_query2_worker_relative
+  cd /scratch
+  run_classify_seqs_worker.py work --queue /usr/local/tests/test_queue_relative.sqlite --idle-timeout 0
+
+  python /usr/local/tests/test_run_classify_seqs.py /usr/local/tests/test_query2_worker_relative.json.gz
+}